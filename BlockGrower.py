@@ -6,19 +6,25 @@ STRATEGIC ATTRACTIVENESS FOR PRESERVATION. THE SCRIPT ALSO ALLOWS FOR SIMULATING
 ALGORITHMS ARE FOLLOWED. PLEASE READ "ARCPY ALGORITHMS FOR STRATEGIC FARMLAND PRESERVATION" REPORT FOR MORE
 INFORMATION.
 
-To create an ArcToolbox tool with which to execute this script, do the following.
-1   In  ArcMap > Catalog > Toolboxes > My Toolboxes, either select an existing toolbox
-    or right-click on My Toolboxes and use New > Toolbox to create (then rename) a new one.
-2   Drag (or use ArcToolbox > Add Toolbox to add) this toolbox to ArcToolbox.
-3   Right-click on the toolbox in ArcToolbox, and use Add > Script to open a dialog box.
-4   In this Add Script dialog box, use Label to name the tool being created, and press Next.
-5   In a new dialog box, browse to the .py file to be invoked by this tool, and press Next.
-6   In the next dialog box, specify the following inputs (using dropdown menus wherever possible)
-    before pressing OK or Finish.
+This script is an ArcGIS Pro (Python 3) script tool; it does not run in ArcMap's Python 2.7. The scoring itself
+is done in memory by the blockengine package (NumPy, SciPy and shapely 2), which must sit in the same folder as
+this script. Pro's default arcgispro-py3 environment lacks shapely 2, so clone it (Package Manager > Environments
+> Clone), add shapely to the clone and make it the active environment. This script only reads the parcels from
+and writes the scores back to ArcGIS.
+To run without ArcGIS, e.g. from a scheduler or over many counties at once, use python -m blockengine with the
+same parameters (see blockengine/cli.py).
+
+To create a script tool with which to execute this script in ArcGIS Pro, do the following.
+1   In the Catalog pane, either select an existing toolbox under Toolboxes
+    or right-click on Toolboxes and use New Toolbox to create (then rename) a new one.
+2   Right-click on the toolbox, and use New > Script to open the script tool dialog box.
+3   On the General tab, use Name and Label to name the tool being created.
+4   Still on the General tab, browse the Script File to this .py file.
+5   On the Parameters tab, specify the following inputs (using dropdown menus wherever possible).
         DISPLAY NAME                    DATA TYPE           PROPERTY>DIRECTION>VALUE
         Parcels                         Feature Layer       Required>Input
         Status_Field                    Field               Required>Input
-        Output_File                     Shapefile           Required>Output
+        Output_File                     Feature Class       Required>Output
         Deprioritize_Large_Blobs        Boolean             Optional>Input
         Method                          String              Required>Input>Filter:ValueList:"Greedy","Patient"
         Jump Distance                   Double              Required>Input
@@ -26,23 +32,32 @@ To create an ArcToolbox tool with which to execute this script, do the following
         Average Neighbor Size Weight    Double              Required>Input>Default:2
         Greedy Score Weight             Double              Required>Input>Default:4
         Averaging Iterations            Double              Required>Input>Default:3
-        Greedy Score Weight             Double              Required>Input>Default:4
         Simulate                        Boolean             Required>Input
         Number of Simulations           Double              Required>Input>Default:1
         Parcels to Preserve             Double              Required>Input>Default:5
-
-7   Additionally, include the following validation script in the Validation tab within the Properties Screen:
+        Tie-Break Field                 Field               Optional>Input>Filter:Field:Short,Long,Float,Double,Text
+        Profile                         Boolean             Optional>Input
+        Trace File                      File                Optional>Output>Filter:File:json
+        Output Mode                     String              Optional>Input>Default:"Split and Merge">
+                                                            Filter:ValueList:"Split and Merge","Scores Only","Score Table"
+        Diagnostics                     Boolean             Optional>Input
+        Patient Solver                  String              Optional>Input>Default:"Passes">
+                                                            Filter:ValueList:"Passes","Iterate","Krylov"
+
+6   Additionally, include the following validation code in the Validation tab:
         def updateParameters(self):
             if self.params[4].value == "Patient":
                 self.params[6].enabled = 1
                 self.params[7].enabled = 1
                 self.params[8].enabled = 1
                 self.params[9].enabled = 1
+                self.params[18].enabled = 1
             else:
                 self.params[6].enabled = 0
                 self.params[7].enabled = 0
                 self.params[8].enabled = 0
                 self.params[9].enabled = 0
+                self.params[18].enabled = 0
 
             if self.params[10].value == True:
                 self.params[11].enabled = 1
@@ -51,361 +66,265 @@ To create an ArcToolbox tool with which to execute this script, do the following
                 self.params[11].enabled = 0
                 self.params[12].enabled = 0
 
-8       To later revise any of this, right-click to the tool's name and select Properties.
-"""
+            if self.params[16].value in ("Scores Only", "Score Table"):
+                self.params[17].enabled = 1
+            else:
+                self.params[17].enabled = 0
 
+    Profile reports the wall time, row and near pair counts and memory high-water mark of every stage once
+    the tool has finished; a Trace File additionally saves them as a JSON trace (chrome://tracing, Perfetto).
 
-# Import necessary modules
-import sys, arcpy, traceback
-import arcpy.cartography as CA
+    Patient Solver "Passes" re-scores only the parcels around each simulation's preserved parcels, pass by pass,
+    keeping every parcel's weight after every pass (8 bytes per parcel and pass); above 20 Averaging Iterations
+    it falls back to "Iterate". "Iterate" and "Krylov" evaluate the averaging with blockengine's PatientSolver
+    over all parcels instead, which is much faster for many Averaging Iterations (Krylov especially for 20 or
+    more).
 
-# Allow output file to overwrite any existing file of the same name
-arcpy.env.overwriteOutput = True
+    Output Mode "Split and Merge" writes the unpreserved parcels followed by the preserved ones, as the tool always
+    did. "Scores Only" copies the parcels to the output once and adds the score field in a single bulk write,
+    keeping every parcel in input order. "Score Table" writes no features at all, only a table of FID, status and
+    score (a .shp output name becomes <name>_scores.dbf) to join to the parcels; parcels with a null status get
+    no row, so they stay null after the join. Diagnostics adds the
+    intermediate fields (POLY_AREA, WeightedAr, SUM_WEIGHT, CombndAcre, GreedyWght and for Patient NeighbArea,
+    COUNT_NEAR, AvgNeighSz, PatientWgt, LocalValue) to the last two modes.
 
+7       To later revise any of this, right-click to the tool's name and select Properties.
 
-def translate(value, oldMin, oldMax, newMin, newMax):
-    ''' maps any value range to 1-100 range'''
+    The output is added to the active map when Pro's "Add output datasets to an open map" option is on.
+"""
 
-    leftSpan = oldMax - oldMin
-    rightSpan = newMax - newMin
 
-    # Convert the left range into a 0-1 range (float)
-    valueScaled = float(value - oldMin) / float(leftSpan)
+# Import necessary modules
+import sys, arcpy, traceback
+import numpy
+import blockengine
+from blockengine import profiling, tableio
 
-    # Convert the 0-1 range into a value in the right range.
-    return newMin + (valueScaled * rightSpan)
+# Allow output file to overwrite any existing file of the same name
+arcpy.env.overwriteOutput = True
 
 
-def preserve(ScoreField):
+def preserve(Parcels, Output, StatusField, Status, NumPreserve, TieBreak):
     '''Changes boolean "preservation status" of the parcels with the highest score'''
 
     arcpy.AddMessage("Preserving " + str(NumPreserve) + " Parcels")
-    # list all scores and take the highest ones (based on user-specified number)
-    FieldValues = arcpy.da.SearchCursor(UnpreservedParcels_Output, ScoreField)
-    ValuesList = list(FieldValues)
-    ValuesList = sorted(ValuesList, reverse=True)
-    ToPreserve = ValuesList[NumPreserve][0]
+    # take exactly the highest ranked parcels (based on user-specified number), breaking ties by raw weight,
+    # the tie-break field and FID
+    ToPreserve = blockengine.top_parcels(Parcels.scores, Parcels.unpreserved, NumPreserve, Parcels.weights, TieBreak)
+
+    # the output holds the parcels of status 0 in input order, including any without a shape, which are not
+    # scored; set status field to 1 for those parcels in a single pass
+    with profiling.stage("preserve", rows=len(ToPreserve)):
+        Rows = numpy.searchsorted(numpy.flatnonzero(numpy.where(Parcels.preserved, 1, Status) == 0), ToPreserve)
+        Oids = tableio.read_fields(Output, [])["OID@"]
+        tableio.write_fields(Output, {StatusField: [1] * len(Rows)}, Oids[Rows])
+
+
+def splitAndMerge(Parcels, ParcelFeatures, Output, StatusField, ScoreField, Status, Simulating, NumPreserve,
+                  TieBreak):
+    '''Writes the unpreserved parcels followed by the preserved ones; parcels of any other status are left out'''
+
+    # copy the parcels into memory with the status and scores of the last iteration
+    with profiling.stage("copy features", rows=len(Status)):
+        NewParcelFeatures = arcpy.CreateFeatureclass_management('in_memory', 'newparcels', 'POLYGON')
+        arcpy.CopyFeatures_management(ParcelFeatures, NewParcelFeatures)
+    with profiling.stage("write scores", rows=len(Status)):
+        tableio.write_fields(NewParcelFeatures, {StatusField: numpy.where(Parcels.preserved, 1, Status),
+                                                 ScoreField: Parcels.scores})
+    arcpy.MakeFeatureLayer_management(NewParcelFeatures, 'ParcelLayer')
+
+    # separate preserved and unpreserved parcels
+    with profiling.stage("split output", rows=len(Status)):
+        PreservedParcels = arcpy.CreateFeatureclass_management('in_memory', 'prsrvd', 'POLYGON')
+        arcpy.SelectLayerByAttribute_management('ParcelLayer', 'NEW_SELECTION', StatusField + " = 1")
+        arcpy.CopyFeatures_management('ParcelLayer', PreservedParcels)
 
-    cur = arcpy.UpdateCursor(UnpreservedParcels_Output)
-    Values = arcpy.SearchCursor(UnpreservedParcels_Output)
-    CurrentRow = Values.next()
+        arcpy.SelectLayerByAttribute_management('ParcelLayer', 'NEW_SELECTION', StatusField + " = 0")
+        arcpy.CopyFeatures_management('ParcelLayer', Output)
 
-    # For each record, if the score is higher than the cutoff, set status field to 1
-    for nextRecord in cur:
-        Score = CurrentRow.getValue(ScoreField)
-        if Score >= ToPreserve:
-            nextRecord.setValue(StatusField, 1)
-        cur.updateRow(nextRecord)
-        # Move to next row in table
-        CurrentRow = Values.next()
+    # if user chose to simulate, change preservation status of highest ranked parcels
+    if Simulating:
+        preserve(Parcels, Output, StatusField, Status, NumPreserve, TieBreak)
 
-    # Delete row and update cursor objects to avoid locking attribute table
-    del cur
-    del CurrentRow
+    # create a placeholder shapefile in memory and re-merge the preserved and unpreserved parcels
+    with profiling.stage("merge output", rows=len(Status)):
+        UnpreservedPlaceholder = arcpy.CreateFeatureclass_management('in_memory', 'unprsrvdPH', 'POLYGON')
+        arcpy.CopyFeatures_management(Output, UnpreservedPlaceholder)
+        arcpy.Merge_management([UnpreservedPlaceholder, PreservedParcels], Output)
 
+    # delete all items created in memory
+    arcpy.Delete_management("in_memory")
 
-try:
 
-    # obtain user input
-    ParcelFeatures = arcpy.GetParameterAsText(0)
-    arcpy.AddMessage('\n' + "Parcel shapefile: " + ParcelFeatures)
+def writeScores(Parcels, ParcelFeatures, Output, OutputMode, StatusField, ScoreField, Oids, Status, Simulating,
+                NumPreserve, TieBreak, Diagnostics):
+    '''
+    Writes the status and scores without splitting and re-merging the parcels: "Scores Only" copies the parcels
+    to the output once and adds the scores in a single bulk write, "Score Table" writes only a table of the
+    scores keyed by FID, leaving out the parcels whose status is null. Returns the path written.
+    '''
 
-    StatusField = arcpy.GetParameterAsText(1)
-    arcpy.AddMessage("The preservation status field is " + StatusField)
+    # Status is masked where it was null
+    Null = numpy.ma.getmaskarray(Status)
+    Status = numpy.ma.getdata(Status)
 
-    UnpreservedParcels_Output = arcpy.GetParameterAsText(2)
-    arcpy.AddMessage("The output shapefile name is " + UnpreservedParcels_Output)
+    # mark the highest ranked parcels of the last iteration as preserved, next to the scores they had
+    FinalStatus = numpy.where(Parcels.preserved, 1, Status)
+    if Simulating:
+        arcpy.AddMessage("Preserving " + str(NumPreserve) + " Parcels")
+        FinalStatus[blockengine.top_parcels(Parcels.scores, Parcels.unpreserved, NumPreserve, Parcels.weights,
+                                            TieBreak)] = 1
 
-    DePrioritizedChecked = arcpy.GetParameterAsText(3)
+    Values = Parcels.fields() if Diagnostics else {ScoreField: Parcels.scores}
 
-    Method = arcpy.GetParameterAsText(4)
+    if OutputMode == "Score Table":
+        if Output.lower().endswith(".shp"):
+            Output = Output[:-4] + "_scores.dbf"
+        Values[StatusField] = FinalStatus
+        # parcels with a null status get no row, so they keep a null status when the table is joined
+        Kept = ~Null
+        with profiling.stage("write score table", rows=int(Kept.sum())):
+            tableio.write_table(Output, Oids[Kept], dict((Name, numpy.asarray(Array)[Kept])
+                                                         for Name, Array in Values.items()))
+        arcpy.AddMessage("Scores written to " + Output + ", join them to the parcels on FID")
+    else:
+        with profiling.stage("copy features", rows=len(Oids)):
+            arcpy.CopyFeatures_management(ParcelFeatures, Output)
+        with profiling.stage("write scores", rows=len(Oids)):
+            OutputOids = tableio.read_fields(Output, [])["OID@"]
+            tableio.add_fields(Output, Values, OutputOids)
+            # the copied status field only needs the parcels the simulation preserved
+            Changed = numpy.flatnonzero((FinalStatus == 1) & (Status != 1))
+            if len(Changed):
+                tableio.write_fields(Output, {StatusField: [1] * len(Changed)}, OutputOids[Changed])
+    return Output
 
-    Jump = int(arcpy.GetParameterAsText(5))
 
-    AccessWeight = int(arcpy.GetParameterAsText(6))
+def main():
+    '''Runs the tool with the parameters it was given'''
 
-    AverageNeighbWeight = int(arcpy.GetParameterAsText(7))
+    Tracer = None
+    try:
 
-    GreedyScoreWeight = int(arcpy.GetParameterAsText(8))
+        # obtain user input
+        ParcelFeatures = arcpy.GetParameterAsText(0)
+        arcpy.AddMessage('\n' + "Parcel shapefile: " + ParcelFeatures)
 
-    AveragingIterations = int(arcpy.GetParameterAsText(9))
+        StatusField = arcpy.GetParameterAsText(1)
+        arcpy.AddMessage("The preservation status field is " + StatusField)
 
-    simulate = arcpy.GetParameterAsText(10)
+        UnpreservedParcels_Output = arcpy.GetParameterAsText(2)
+        arcpy.AddMessage("The output shapefile name is " + UnpreservedParcels_Output)
 
-    NumSimulations = max(int(arcpy.GetParameterAsText(11)),1)
+        # square map units per acre, used for parcel and blob acreage; geographic coordinates have no area units
+        SpatialReference = arcpy.Describe(ParcelFeatures).spatialReference
+        if SpatialReference.type != "Projected":
+            arcpy.AddError("The parcels must be in a projected coordinate system, not " + SpatialReference.name +
+                           "; acreage and the jump distance are measured in its map units. Project them first.")
+            return
+        AcreFactor = blockengine.SQM_PER_ACRE / SpatialReference.metersPerUnit ** 2
 
-    NumPreserve = int(arcpy.GetParameterAsText(12))
+        DePrioritizedChecked = arcpy.GetParameterAsText(3)
 
-    # if not simulating, only iterate over code once
-    if str(simulate) != "true":
-        NumSimulations = 1
+        Method = arcpy.GetParameterAsText(4)
 
-    # begin counting number of times simulation has run
-    simcount = 0
+        Jump = int(arcpy.GetParameterAsText(5))
 
-    # begin iterations
-    for i in range(0,NumSimulations):
+        AccessWeight = int(arcpy.GetParameterAsText(6))
 
-        # if currently in the middle of simulation. Set output layer from previous iteration to new input layer.
-        if str(simulate) == "true" and simcount > 0:
-            arcpy.AddMessage("Simulating iteration " + str(i+1))
-            arcpy.DeleteField_management(UnpreservedParcels_Output, ['PatientScr','GreedyScr'])
-            NewParcelFeatures = arcpy.CreateFeatureclass_management('in_memory', 'newparcels', 'POLYGON')
-            arcpy.CopyFeatures_management(UnpreservedParcels_Output, NewParcelFeatures)
-            arcpy.MakeFeatureLayer_management(NewParcelFeatures, 'ParcelLayer')
+        AverageNeighbWeight = int(arcpy.GetParameterAsText(7))
 
-        # if not simulating or on first simulation iteration, use user-specified input layer
-        elif str(simulate) == "true" and simcount == 0:
-            arcpy.AddMessage("Simulating iteration " + str(i + 1))
-            arcpy.MakeFeatureLayer_management(ParcelFeatures, 'ParcelLayer')
+        GreedyScoreWeight = int(arcpy.GetParameterAsText(8))
 
-        else:
-            arcpy.MakeFeatureLayer_management(ParcelFeatures, 'ParcelLayer')
+        AveragingIterations = int(arcpy.GetParameterAsText(9))
 
-        # create layers in memory as placeholder for output
-        PreservedParcels = arcpy.CreateFeatureclass_management('in_memory', 'prsrvd', 'POLYGON')
-        PreservedParcels_Output = arcpy.CreateFeatureclass_management('in_memory', 'prsrvdout', 'POLYGON')
+        simulate = arcpy.GetParameterAsText(10)
 
-        # separate preserved and unpreserved parcels for separate analyses
-        arcpy.SelectLayerByAttribute_management('ParcelLayer', 'NEW_SELECTION', StatusField + " = 1")
-        arcpy.CopyFeatures_management('ParcelLayer', PreservedParcels)
-
-        arcpy.SelectLayerByAttribute_management('ParcelLayer', 'NEW_SELECTION', StatusField + " = 0")
-        arcpy.CopyFeatures_management('ParcelLayer', UnpreservedParcels_Output)
-
-        # calculate "blob" size of preserved parcels
-        CA.AggregatePolygons(PreservedParcels, PreservedParcels_Output, Jump, "", "", "ORTHOGONAL", "", "")
-        arcpy.AddGeometryAttributes_management(PreservedParcels_Output, "AREA", "", "ACRES")
-        arcpy.AddGeometryAttributes_management(UnpreservedParcels_Output, "AREA", "", "ACRES")
+        NumSimulations = max(int(arcpy.GetParameterAsText(11)),1)
 
-        # set deprioritization factors if user chose to deprioritize large blobs
-        if str(DePrioritizedChecked) == "true":
-            factor500 = 0
-            factor250 = 0.5
-        else:
-            factor500 = 1
-            factor250 = 1
-
-        # create new field to store blob size
-        arcpy.AddField_management(PreservedParcels_Output, "WeightedAr", "FLOAT")
-
-        # Create an enumeration of updatable records from the shapefile's attribute table
-        cur = arcpy.UpdateCursor(PreservedParcels_Output)
-
-        # Start cursor at the beginning of the attribute table
-        Values = arcpy.SearchCursor(PreservedParcels_Output)
-        CurrentRow = Values.next()
-
-        # calculate blob size while taking into account the deprioritization factors
-        for nextRecord in cur:
-            CurrentValue = CurrentRow.getValue("POLY_AREA")
-            if CurrentValue >= 500:
-                nextRecord.setValue("WeightedAr", CurrentValue * factor500)
-                cur.updateRow(nextRecord)
-            elif CurrentValue >= 250 and CurrentValue < 500 >= 250:
-                nextRecord.setValue("WeightedAr", CurrentValue * factor250)
-                cur.updateRow(nextRecord)
-            else:
-                nextRecord.setValue("WeightedAr", CurrentValue)
-                cur.updateRow(nextRecord)
-            # Move to next row in table
-            CurrentRow = Values.next()
-
-        # Delete row and update cursor objects to avoid locking attribute table
-        del cur
-        del CurrentRow
-
-        # create placeholder tables for upcoming calculations
-        near_table = arcpy.management.CreateTable('in_memory', 'near_table')
-        sum_table = arcpy.management.CreateTable('in_memory', 'sum_table')
-
-        # calculate area sum of nearby preserved blobs for each unpreserved parcel.
-        arcpy.GenerateNearTable_analysis(UnpreservedParcels_Output, PreservedParcels_Output, near_table, Jump, "", "", "ALL", "0", "PLANAR")
-        arcpy.JoinField_management(near_table, "NEAR_FID", PreservedParcels_Output, "FID", "WeightedAr")
-        arcpy.Statistics_analysis(near_table, sum_table, [["WeightedAr", "SUM"]], "IN_FID")
-        arcpy.JoinField_management(UnpreservedParcels_Output, "FID", sum_table, "IN_FID", "SUM_WEIGHTEDAR")
-
-        # combine the nearby blob area to the size of the unpreserved parcel and store in new combined acre field
-        arcpy.AddField_management(UnpreservedParcels_Output, "CombndAcre", "FLOAT")
-        arcpy.CalculateField_management(UnpreservedParcels_Output, "CombndAcre", "!SUM_WEIGHT! + !POLY_AREA!", "PYTHON_9.3","")
-
-        # create "greedy weight" field to store upcoming information
-        arcpy.AddField_management(UnpreservedParcels_Output, "GreedyWght", "FLOAT")
-
-        cur = arcpy.UpdateCursor(UnpreservedParcels_Output)
-        Values = arcpy.SearchCursor(UnpreservedParcels_Output)
-        CurrentRow = Values.next()
-
-        # loop through records and assign a "greedy weight" by adding the parcel's own value and the surrounding
-        # "combined value".
-        for nextRecord in cur:
-            ParcelValue = CurrentRow.getValue("POLY_AREA")
-            CombinedValue = CurrentRow.getValue("CombndAcre")
-            SurroundingValue = CurrentRow.getValue("SUM_WEIGHT")
-            if SurroundingValue == 0:
-                nextRecord.setValue("GreedyWght", ParcelValue)
-            else:
-                nextRecord.setValue("GreedyWght", CombinedValue + ParcelValue)
-            cur.updateRow(nextRecord)
-            # Move to next row in table
-            CurrentRow = Values.next()
+        NumPreserve = int(arcpy.GetParameterAsText(12))
 
-        # only perform if method is set to greedy
-        if Method == "Greedy":
+        TieBreakField = arcpy.GetParameterAsText(13)
 
-            # create final "greedy score" field
-            arcpy.AddField_management(UnpreservedParcels_Output, "GreedyScr", "INTEGER")
+        Profile = arcpy.GetParameterAsText(14)
 
-            # Delete row and update cursor objects to avoid locking attribute table
-            del cur
-            del CurrentRow
+        TraceFile = arcpy.GetParameterAsText(15)
 
-            FieldValues = arcpy.da.SearchCursor(UnpreservedParcels_Output, "GreedyWght")
-            ValuesList = list(FieldValues)
-            MaxSize = max(ValuesList)
-            MinSize = min(ValuesList)
+        OutputMode = arcpy.GetParameterAsText(16) or "Split and Merge"
 
-            cur = arcpy.UpdateCursor(UnpreservedParcels_Output)
-            Values = arcpy.SearchCursor(UnpreservedParcels_Output)
-            CurrentRow = Values.next()
+        Diagnostics = arcpy.GetParameterAsText(17)
 
-            # loop through records and translate greedy weight to greedy score from 1-100
-            for nextRecord in cur:
-                WeightValue = CurrentRow.getValue("GreedyWght")
-                NewValue = translate(WeightValue, MinSize[0], MaxSize[0], 1, 100)
-                nextRecord.setValue("GreedyScr", NewValue)
-                cur.updateRow(nextRecord)
-                # Move to next row in table
-                CurrentRow = Values.next()
+        SolverMethod = arcpy.GetParameterAsText(18)
+        Solver = blockengine.PatientSolver(SolverMethod.lower()) if SolverMethod in ("Iterate", "Krylov") else None
 
-            # Delete row and update cursor objects to avoid locking attribute table
-            del cur
-            del CurrentRow
+        # record the stages of this run if profiling was asked for
+        Tracer = blockengine.Tracer() if str(Profile) == "true" or TraceFile else None
+        if Tracer is not None:
+            profiling.install(Tracer)
 
-            # if user chose to simulate, change preservation status of highest ranked parcels
-            if str(simulate) == "true":
-                preserve("GreedyScr")
+        # if not simulating, only iterate over code once
+        if str(simulate) != "true":
+            NumSimulations = 1
 
+        # read geometry and preservation status of every parcel in a single pass
+        with profiling.stage("read parcels") as Counts:
+            Oids, Geometries, Status = tableio.read_parcels(ParcelFeatures, StatusField)
+            TieBreak = None
+            if TieBreakField:
+                # a text tie-break field ranks by sort order, with empty text for nulls
+                IsText = arcpy.ListFields(ParcelFeatures, TieBreakField)[0].type == "String"
+                TieBreak = tableio.read_fields(ParcelFeatures, [TieBreakField], "" if IsText else 0)[TieBreakField]
+            Counts["rows"] = len(Oids)
 
-
-        else:
+        # score the unpreserved parcels (blob sizes, nearby blob area, greedy and patient weights) in memory
+        if Method == "Patient":
             arcpy.AddMessage("This might take a while...")
-
-            # create empty tables in memory for future calculations
-            near_table2 = arcpy.management.CreateTable('in_memory', 'near_table2')
-            sum_table2 = arcpy.management.CreateTable('in_memory', 'sum_table2')
-
-            # calculate the total area to which each parcel has access (total area of neighboring parcels)
-            arcpy.GenerateNearTable_analysis(UnpreservedParcels_Output, UnpreservedParcels_Output, near_table2, Jump, "", "", "ALL", "0", "PLANAR")
-            arcpy.JoinField_management(near_table2, "NEAR_FID", UnpreservedParcels_Output, "FID", "POLY_AREA")
-            arcpy.Statistics_analysis(near_table2, sum_table2, [["POLY_AREA", "SUM"],["NEAR_FID", "COUNT"]], "IN_FID")
-            arcpy.JoinField_management(UnpreservedParcels_Output, "FID", sum_table2, "IN_FID", "SUM_POLY_AREA")
-            arcpy.AddField_management(UnpreservedParcels_Output, "NeighbArea", "FLOAT")
-            arcpy.CalculateField_management(UnpreservedParcels_Output, "NeighbArea", "!SUM_POLY_A!", "PYTHON_9.3", "")
-
-            # calculate the average size of each parcel's neighboring parcels
-            arcpy.JoinField_management(UnpreservedParcels_Output, "FID", sum_table2, "IN_FID", "COUNT_NEAR_FID")
-
-            arcpy.AddField_management(UnpreservedParcels_Output, "AvgNeighSz", "FLOAT")
-            arcpy.AddField_management(UnpreservedParcels_Output, "PatientWgt", "FLOAT")
-
-            cur = arcpy.UpdateCursor(UnpreservedParcels_Output)
-            Values = arcpy.SearchCursor(UnpreservedParcels_Output)
-            CurrentRow = Values.next()
-
-            for nextRecord in cur:
-                SizeNeighbors = CurrentRow.getValue("NeighbArea")
-                NumNeighbors = CurrentRow.getValue("COUNT_NEAR")
-                if NumNeighbors == 0:
-                    nextRecord.setValue("AvgNeighSz", 0)
-                else:
-                    nextRecord.setValue("AvgNeighSz", SizeNeighbors / NumNeighbors)
-
-                Combined = CurrentRow.getValue("GreedyWght")
-                AverageNeighbs = CurrentRow.getValue("AvgNeighSz")
-
-                # set the patient weight value by adding all calculated score and weighing them by user specified amounts
-                nextRecord.setValue("PatientWgt", (SizeNeighbors * AccessWeight) + (AverageNeighbs * AverageNeighbWeight) + (Combined * GreedyScoreWeight))
-                cur.updateRow(nextRecord)
-                CurrentRow = Values.next()
-
-            # Delete row and update cursor objects to avoid locking attribute table
-            del cur
-            del CurrentRow
-
-            # create empty tables in memory for future calculations
-            near_table3 = arcpy.management.CreateTable('in_memory', 'near_table3')
-            sum_table3 = arcpy.management.CreateTable('in_memory', 'sum_table3')
-
-            arcpy.AddField_management(UnpreservedParcels_Output, "LocalValue", "FLOAT")
-
-            # based on user-specified number of iterations, give each parcel the average patient weight of the surrounding parcels
-            for i in range(AveragingIterations):
-                arcpy.AddMessage("Averaging iteration " + str(i + 1))
-                arcpy.GenerateNearTable_analysis(UnpreservedParcels_Output, UnpreservedParcels_Output, near_table3, Jump, "","", "ALL", "0", "PLANAR")
-                arcpy.JoinField_management(near_table3, "NEAR_FID", UnpreservedParcels_Output, "FID", "PatientWgt")
-                arcpy.Statistics_analysis(near_table3, sum_table3, [["PatientWgt", "MEAN"]], "IN_FID")
-                arcpy.JoinField_management(UnpreservedParcels_Output, "FID", sum_table3, "IN_FID", "MEAN_PatientWgt")
-                arcpy.CalculateField_management(UnpreservedParcels_Output, "PatientWgt", "(!MEAN_Patie!+!PatientWgt!)/2", "PYTHON_9.3", "")
-                arcpy.DeleteField_management(UnpreservedParcels_Output, "MEAN_Patie")
-
-                arcpy.CalculateField_management(UnpreservedParcels_Output, "LocalValue", "!LocalValue! + !PatientWgt!", "PYTHON_9.3", "")
-
-            arcpy.AddField_management(UnpreservedParcels_Output, "PatientScr", "INTEGER")
-
-            FieldValues = arcpy.da.SearchCursor(UnpreservedParcels_Output, "LocalValue")
-            ValuesList = list(FieldValues)
-            MaxSize = max(ValuesList)
-            MinSize = min(ValuesList)
-
-            cur = arcpy.UpdateCursor(UnpreservedParcels_Output)
-            Values = arcpy.SearchCursor(UnpreservedParcels_Output)
-            CurrentRow = Values.next()
-
-            # Map each patient weight to a patient score from 1-100
-            for nextRecord in cur:
-                WeightValue = CurrentRow.getValue("LocalValue")
-                NewValue = translate(WeightValue, MinSize[0], MaxSize[0], 1, 100)
-                nextRecord.setValue("PatientScr", NewValue)
-                cur.updateRow(nextRecord)
-                # Move to next row in table
-                CurrentRow = Values.next()
-
-            # Delete row and update cursor objects to avoid locking attribute table
-            del cur
-            del CurrentRow
-
-            # if user chose to simulate, change preservation status of highest ranked parcels
-            if str(simulate) == "true":
-                preserve("PatientScr")
-
-        # delete all interim calculated fields
-        arcpy.DeleteField_management(UnpreservedParcels_Output, ['LocalValue','PatientWgt','AvgNeighSz','COUNT_NEAR','NeighbArea','SUM_POLY_A','GreedyWght','CombndAcre','SUM_Weight','POLY_AREA'])
-
-        # create a placeholder shapefile in memory and re-merge the preserved and unpreserved parcels
-        UnpreservedPlaceholder = arcpy.CreateFeatureclass_management('in_memory', 'unprsrvdPH', 'POLYGON')
-        arcpy.CopyFeatures_management(UnpreservedParcels_Output, UnpreservedPlaceholder)
-        arcpy.Merge_management([UnpreservedPlaceholder, PreservedParcels], UnpreservedParcels_Output)
-
-        # count the number of simulations
-        simcount = simcount + 1
-
-        # delete all items created in memory
-        arcpy.Delete_management("in_memory")
-
-
-    # Add a layer for that new shapefile to the active data frame
-    currentMap = arcpy.mapping.MapDocument("CURRENT")
-    currentDataFrame = currentMap.activeDataFrame
-    layerToBeDisplayed = arcpy.mapping.Layer(UnpreservedParcels_Output)
-    arcpy.mapping.AddLayer(currentDataFrame, layerToBeDisplayed, "TOP")
-    del currentMap
-
-
-except Exception as e:
-    # If unsuccessful, end gracefully by indicating why
-    arcpy.AddError('\n' + "Script failed because: \t\t" + e.message)
-    # ... and where
-    exceptionreport = sys.exc_info()[2]
-    fullermessage = traceback.format_tb(exceptionreport)[0]
-    arcpy.AddError("at this location: \n\n" + fullermessage + "\n")
+        ScoreField = blockengine.SCORE_FIELDS[Method]
+        Parcels = blockengine.Scorer(Geometries, Status, Method, Jump, str(DePrioritizedChecked) == "true", AccessWeight,
+                                     AverageNeighbWeight, GreedyScoreWeight, AveragingIterations, AcreFactor,
+                                     Solver)
+
+        # in every simulation iteration but the last, preserve the highest ranked parcels and only re-score the
+        # parcels around them
+        for i in range(0, NumSimulations - 1):
+            arcpy.AddMessage("Simulating iteration " + str(i + 1))
+            blockengine.simulate(Parcels, 1, NumPreserve, TieBreak)
+        if str(simulate) == "true":
+            arcpy.AddMessage("Simulating iteration " + str(NumSimulations))
+
+        # write the status and scores of the last iteration
+        Simulating = str(simulate) == "true"
+        if OutputMode == "Split and Merge":
+            splitAndMerge(Parcels, ParcelFeatures, UnpreservedParcels_Output, StatusField, ScoreField, Status,
+                          Simulating, NumPreserve, TieBreak)
+        else:
+            UnpreservedParcels_Output = writeScores(Parcels, ParcelFeatures, UnpreservedParcels_Output, OutputMode,
+                                                    StatusField, ScoreField, Oids, Status, Simulating, NumPreserve,
+                                                    TieBreak, str(Diagnostics) == "true")
+
+        # hand the path actually written back to Pro, which adds the output to the active map
+        if OutputMode != "Score Table":
+            arcpy.SetParameterAsText(2, UnpreservedParcels_Output)
+
+    except Exception as e:
+        # If unsuccessful, end gracefully by indicating why
+        arcpy.AddError('\n' + "Script failed because: \t\t" + str(e))
+        # ... and where
+        exceptionreport = sys.exc_info()[2]
+        fullermessage = traceback.format_tb(exceptionreport)[0]
+        arcpy.AddError("at this location: \n\n" + fullermessage + "\n")
+
+    finally:
+        # report where the time and memory went, also (and especially) when the run failed
+        if Tracer is not None:
+            profiling.uninstall(Tracer)
+            arcpy.AddMessage('\n' + "Stage timings:")
+            for Line in Tracer.summary():
+                arcpy.AddMessage(Line)
+            if TraceFile:
+                Tracer.write_chrome_trace(TraceFile)
+                arcpy.AddMessage("Trace written to " + TraceFile)
+
+
+if __name__ == '__main__':
+    main()
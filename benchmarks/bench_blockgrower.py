@@ -0,0 +1,149 @@
+"""
+Benchmarks of the BlockGrower scoring engine on synthetic parcel fabrics.
+
+For every combination of fabric, size, preserved fraction and jump distance the stages of a run are timed
+separately: neighbor graph (the near tables), blob aggregation, greedy weighting, patient averaging,
+preserve() selection and simulation rounds, and the process's peak resident size is reported at the end.
+With --memory each stage also records its peak traced memory (NumPy and Python allocations); tracing slows
+the stages down, so time regressions are best compared on runs without it. Before timing anything, a
+correctness check compares the engine's scores with the reference implementation on a small fabric.
+
+    python benchmarks/bench_blockgrower.py --sizes 1000 10000 100000 --fabrics grid voronoi \\
+        --preserved 0.1 --jumps 0 50 --output bench.json
+
+--processes splits the neighbor search across worker processes, to measure how it scales with cores.
+
+Results are written as JSON: one record per configuration and stage.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blockengine import Scorer, acreage, neighbor_graph, simulate, top_parcels
+from blockengine.blobs import find_blobs
+from blockengine.profiling import peak_memory
+from fabrics import FABRICS, random_status
+from reference import reference_scores
+
+
+# set by --memory: trace allocations, which roughly doubles the wall times, so they are not comparable
+TRACE_MEMORY = False
+
+
+def timed(records, config, stage, function, *args):
+    '''
+    runs function(*args), appending its wall time (and, with TRACE_MEMORY, its peak traced memory) to
+    records; returns its result
+    '''
+
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak = None
+    if TRACE_MEMORY:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    record = dict(config, stage=stage, seconds=seconds, peak_bytes=peak, traced=TRACE_MEMORY)
+    records.append(record)
+    print("{fabric:>8} {parcels:>9} {preserved:>5} {jump:>6g} {method:>8}  {stage:<20} {seconds:9.3f} s {mb}".format(
+        mb="" if peak is None else "{0:9.1f} MB".format(peak / 2.0 ** 20), **record))
+    return result
+
+
+def check_correctness(size=300, jumps=(0, 50)):
+    '''compares the engine's Greedy and Patient weights and scores with the reference implementation'''
+
+    failures = []
+    for name, fabric in sorted(FABRICS.items()):
+        geoms = fabric(size)
+        status = random_status(len(geoms), 0.15)
+        for jump in jumps:
+            for method in ("Greedy", "Patient"):
+                expected = reference_scores(geoms, status, method, jump, True)
+                scorer = Scorer(geoms, status, method, jump, True)
+                if not (np.allclose(scorer.weights, expected["weights"], rtol=1e-9) and
+                        np.array_equal(scorer.scores, expected["scores"])):
+                    failures.append("{0} fabric, {1}, jump {2}".format(name, method, jump))
+    return failures
+
+
+def bench(fabric, size, preserved, jump, methods, iterations, rounds, num_preserve, records, processes=1):
+    '''times every stage of one configuration; the graph and blobs are shared by the methods'''
+
+    geoms = FABRICS[fabric](size)
+    status = random_status(len(geoms), preserved)
+    config = dict(fabric=fabric, parcels=len(geoms), preserved=preserved, jump=jump, method="-",
+                  processes=processes)
+
+    graph = timed(records, config, "neighbor graph", neighbor_graph, geoms, jump, None, processes)
+    area = acreage(geoms)
+    timed(records, config, "blob aggregation", find_blobs, graph, np.flatnonzero(status == 1), area)
+    for method in methods:
+        config["method"] = method
+        scorer = Scorer.from_graph(area, graph, status, method, True, averaging_iterations=iterations)
+        unpreserved = np.flatnonzero(scorer.unpreserved)
+        timed(records, config, "greedy weighting", scorer._update_greedy, unpreserved)
+        if method == "Patient":
+            timed(records, config, "patient averaging", scorer._update_patient, unpreserved)
+        timed(records, config, "preserve selection", top_parcels, scorer.scores, scorer.unpreserved,
+              num_preserve, scorer.weights)
+        timed(records, config, "simulation rounds", simulate, scorer.copy(), rounds, num_preserve)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--fabrics", nargs="+", choices=sorted(FABRICS), default=sorted(FABRICS))
+    parser.add_argument("--preserved", type=float, nargs="+", default=[0.1])
+    parser.add_argument("--jumps", type=float, nargs="+", default=[0, 50])
+    parser.add_argument("--methods", nargs="+", choices=["Greedy", "Patient"], default=["Greedy", "Patient"])
+    parser.add_argument("--iterations", type=int, default=3, help="Patient averaging iterations")
+    parser.add_argument("--rounds", type=int, default=10, help="simulation rounds")
+    parser.add_argument("--num-preserve", type=int, default=5, help="parcels preserved per round")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes for the neighbor search (0 for all CPUs)")
+    parser.add_argument("--memory", action="store_true",
+                        help="also record the peak traced memory of every stage (inflates the wall times)")
+    parser.add_argument("--output", help="JSON file for the results")
+    parser.add_argument("--skip-check", action="store_true", help="skip the correctness check")
+    args = parser.parse_args(argv)
+    global TRACE_MEMORY
+    TRACE_MEMORY = args.memory
+
+    failures = [] if args.skip_check else check_correctness()
+    for failure in failures:
+        print("correctness check failed: " + failure)
+
+    records = []
+    for fabric in args.fabrics:
+        for size in args.sizes:
+            for preserved in args.preserved:
+                for jump in args.jumps:
+                    bench(fabric, size, preserved, jump, args.methods, args.iterations, args.rounds,
+                          args.num_preserve, records, args.processes or None)
+
+    peak_rss = peak_memory()
+    if peak_rss is not None:
+        print("peak resident size {0:.1f} MB".format(peak_rss / 2.0 ** 20))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                       "numpy": np.__version__, "correctness_failures": failures, "peak_rss_bytes": peak_rss,
+                       "results": records}, f, indent=1)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
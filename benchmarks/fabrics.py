@@ -0,0 +1,44 @@
+"""
+Synthetic parcel fabrics for benchmarking BlockGrower.
+
+grid_fabric     rectangular parcels on a regular grid, each shrunk by a random margin so that gaps of
+                varying width separate neighbors
+voronoi_fabric  irregular parcels: the Voronoi cells of random points, clipped to the study area
+
+Coordinates are in feet; with the default parcel_size of 660 ft a grid parcel is about 10 acres.
+"""
+
+import numpy as np
+import shapely
+
+
+def grid_fabric(n, parcel_size=660.0, max_gap=60.0, seed=0):
+    '''about n rectangular parcels (rounded to a square grid) separated by gaps of 0 to max_gap feet'''
+
+    rng = np.random.default_rng(seed)
+    side = max(int(round(np.sqrt(n))), 1)
+    x, y = np.meshgrid(np.arange(side) * parcel_size, np.arange(side) * parcel_size)
+    x, y = x.ravel(), y.ravel()
+    gap = rng.uniform(0, max_gap, (4, len(x)))
+    return shapely.box(x + gap[0] / 2, y + gap[1] / 2, x + parcel_size - gap[2] / 2, y + parcel_size - gap[3] / 2)
+
+
+def voronoi_fabric(n, parcel_size=660.0, seed=0):
+    '''n irregular parcels averaging parcel_size squared in area, sharing their boundaries'''
+
+    rng = np.random.default_rng(seed)
+    extent = np.sqrt(n) * parcel_size
+    points = shapely.multipoints(rng.uniform(0, extent, (n, 2)))
+    box = shapely.box(0, 0, extent, extent)
+    cells = shapely.get_parts(shapely.voronoi_polygons(points, extend_to=box))
+    return shapely.intersection(cells, box)
+
+
+def random_status(n, preserved_fraction=0.1, seed=0):
+    '''status array with about preserved_fraction of the parcels preserved (1) and the rest unpreserved (0)'''
+
+    rng = np.random.default_rng(seed + 1)
+    return (rng.random(n) < preserved_fraction).astype(np.int64)
+
+
+FABRICS = {"grid": grid_fabric, "voronoi": voronoi_fabric}
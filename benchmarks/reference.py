@@ -0,0 +1,76 @@
+"""
+A deliberately plain reference implementation of the BlockGrower scores.
+
+It follows the ArcToolbox script step by step with Python loops and pairwise distances, without any
+spatial index or sparse matrix, so it is only usable on a few hundred parcels. The benchmark compares
+blockengine against it to catch regressions in the scores, not just in the timings.
+"""
+
+import numpy as np
+
+
+def reference_scores(geoms, status, method="Greedy", jump=0, deprioritize=False, access_weight=1,
+                     average_neighb_weight=2, greedy_score_weight=4, averaging_iterations=3,
+                     acre_factor=43560.0):
+    '''dict with the raw weight and the 1-100 score of every parcel (0 for preserved parcels)'''
+
+    n = len(geoms)
+    area = [g.area / acre_factor for g in geoms]
+    near = [[j for j in range(n) if j != i and geoms[i].distance(geoms[j]) <= jump] for i in range(n)]
+    preserved = [i for i in range(n) if status[i] == 1]
+    unpreserved = [i for i in range(n) if status[i] == 0]
+
+    # blobs: preserved parcels reachable from each other in jumps
+    blob = {}
+    for start in preserved:
+        if start in blob:
+            continue
+        blob[start] = start
+        stack = [start]
+        while stack:
+            i = stack.pop()
+            for j in near[i]:
+                if status[j] == 1 and j not in blob:
+                    blob[j] = start
+                    stack.append(j)
+    blob_area = {}
+    for i in preserved:
+        blob_area[blob[i]] = blob_area.get(blob[i], 0) + area[i]
+    for b, a in blob_area.items():
+        if deprioritize and a >= 500:
+            blob_area[b] = a * 0
+        elif deprioritize and a >= 250:
+            blob_area[b] = a * 0.5
+
+    greedy = {}
+    for i in unpreserved:
+        sum_weight = sum(blob_area[b] for b in set(blob[j] for j in near[i] if status[j] == 1))
+        greedy[i] = area[i] if sum_weight == 0 else sum_weight + 2 * area[i]
+
+    if method == "Greedy":
+        weight = greedy
+    else:
+        neighbors = dict((i, [j for j in near[i] if status[j] == 0]) for i in unpreserved)
+        patient = {}
+        for i in unpreserved:
+            neighb_area = sum(area[j] for j in neighbors[i])
+            avg_size = neighb_area / len(neighbors[i]) if neighbors[i] else 0
+            patient[i] = neighb_area * access_weight + avg_size * average_neighb_weight + greedy[i] * greedy_score_weight
+        weight = dict((i, 0.0) for i in unpreserved)
+        for iteration in range(averaging_iterations):
+            mean = dict((i, sum(patient[j] for j in neighbors[i]) / len(neighbors[i]) if neighbors[i] else 0)
+                        for i in unpreserved)
+            patient = dict((i, (mean[i] + patient[i]) / 2) for i in unpreserved)
+            for i in unpreserved:
+                weight[i] += patient[i]
+
+    weights = np.zeros(n)
+    scores = np.zeros(n, dtype=np.int64)
+    if unpreserved:
+        low = min(weight.values())
+        high = max(weight.values())
+        for i in unpreserved:
+            weights[i] = weight[i]
+            scaled = 100.0 if high == low else 1 + (weight[i] - low) / (high - low) * 99
+            scores[i] = int(np.floor(scaled + 0.5))
+    return {"weights": weights, "scores": scores}
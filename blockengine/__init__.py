@@ -0,0 +1,26 @@
+"""
+blockengine - the arcpy-free scoring engine behind BlockGrower.
+
+Requires NumPy, SciPy and shapely 2. BlockGrower.py reads the parcels from ArcGIS and hands them to a
+Scorer, which re-scores incrementally between simulation iterations; Scorer and score_parcels() work on
+any shapely geometries, e.g. parcels read with fiona or GeoPandas.
+
+montecarlo.monte_carlo() runs stochastic Simulate trajectories on a process pool; it needs Python 3.8+
+shared memory, so it is imported from blockengine.montecarlo rather than with the package.
+
+Engine stages report their wall time, counts and memory to a profiling.Tracer once one is installed.
+
+tiles.score_tiled() scores parcel files too large for memory tile by tile (needs fiona, pyarrow for Parquet).
+batch.run_jobs() and the command line (python -m blockengine) run the tool's parameters on parcel files
+without ArcGIS, many jobs at a time (needs fiona).
+"""
+
+from .blobs import BlobSet, components, find_blobs
+from .graph import adjacency, near_pairs, near_table, neighbor_graph
+from .scoring import (METHODS, SCORE_FIELDS, SQFT_PER_ACRE, SQM_PER_ACRE, Scorer, acreage, as_geometries,
+                      score_parcels, to_score, translate, weighted_area)
+from .profiling import Tracer
+from .solver import PatientSolver, SolverResult
+from .simulate import random_parcels, simulate, top_parcels
+from .store import ParcelStore, open_store
+from .sweep import GraphCache, SweepPoint, sweep
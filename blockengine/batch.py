@@ -0,0 +1,304 @@
+"""
+Headless BlockGrower runs: the tool's parameters as a Job, run without ArcGIS and many at a time.
+
+run_job() reads a parcel file with fiona, scores it (simulating if asked to) and writes the parcels with
+their status and score to the job's output file; no map document or other ArcGIS state is touched. Unlike
+the tool, which splits and re-merges the output, the output keeps every parcel in input order. run_jobs()
+runs a list of jobs, e.g. one per county from read_manifest(), across a bounded pool of worker processes.
+
+A job with trajectories also runs that many Monte Carlo trajectories (see blockengine.montecarlo), drawing
+parcels at random by score and, with a willingness field, by each owner's probability of agreeing to sell;
+the fraction of trajectories that preserve each parcel is written to the output as PresrvFreq.
+
+A job with a store directory keeps the parcels' acreage and neighbor graphs there (see blockengine.store):
+while the parcel file is unchanged, a repeated job reads only its attributes, not its geometry.
+
+A job with a tile size never holds all geometry in memory: like tiles.score_tiled(), it builds the neighbor
+graph tile by tile, for parcel files too large to read at once. Only the geometry is bounded by the tile
+size; the neighbor graph and the per-parcel arrays still grow with the whole file.
+
+Needs fiona to read and write parcel files (pyarrow for Parquet score tables).
+"""
+
+import collections
+import concurrent.futures
+import csv
+import json
+import os
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from .montecarlo import monte_carlo
+from .scoring import SCORE_FIELDS, SQM_PER_ACRE, Scorer
+from .simulate import simulate, top_parcels
+from .solver import SOLVER_METHODS, PatientSolver
+from .store import open_store
+from .tiles import _open, _shape, tiled_scorer, write_scores
+
+# the BlockGrower tool parameters, with the tool's defaults
+Job = collections.namedtuple("Job", ["parcels", "status_field", "output", "method", "jump", "deprioritize",
+                                     "access_weight", "average_neighb_weight", "greedy_score_weight",
+                                     "averaging_iterations", "simulate", "simulations", "num_preserve",
+                                     "tiebreak_field", "layer", "acre_factor", "processes", "solver",
+                                     "solver_tol", "rank_patience", "store", "trajectories", "willingness_field",
+                                     "seed", "tile_size", "mc_processes"])
+# acre_factor None reads the linear units from the parcel file's CRS; processes splits the neighbor search and
+# mc_processes runs the Monte Carlo trajectories (None for all CPUs)
+Job.__new__.__defaults__ = ("Greedy", 0, False, 1, 2, 4, 3, False, 1, 5, None, None, None, 1, None, None, None,
+                            None, 0, None, None, None, None)
+
+# output field of the Monte Carlo preservation frequency
+FREQUENCY_FIELD = "PresrvFreq"
+
+JobResult = collections.namedtuple("JobResult", ["job", "parcels", "preserved", "seconds", "error"])
+
+
+def _boolean(value):
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "y")
+    return bool(value)
+
+
+def _optional(value):
+    return None if value in (None, "") else value
+
+
+def _optional_float(value):
+    return None if value in (None, "") else float(value)
+
+
+def _processes(value):
+    # 0 stands for all CPUs
+    return int(value) or None
+
+
+# how manifest values (strings in a CSV) are converted to Job fields
+CONVERTERS = {"jump": float, "deprioritize": _boolean, "access_weight": float, "average_neighb_weight": float,
+              "greedy_score_weight": float, "averaging_iterations": int, "simulate": _boolean,
+              "simulations": int, "num_preserve": int, "tiebreak_field": _optional, "layer": _optional,
+              "acre_factor": _optional_float, "processes": _processes, "solver": _optional, "solver_tol": float,
+              "rank_patience": int, "store": _optional, "trajectories": int, "willingness_field": _optional,
+              "seed": int, "tile_size": _optional_float, "mc_processes": _processes}
+
+
+def make_job(values):
+    '''Job from a dict of field values (a manifest entry), converting them and filling in the defaults'''
+
+    unknown = set(values) - set(Job._fields)
+    if unknown:
+        raise ValueError("unknown job fields: {0}".format(", ".join(sorted(unknown))))
+    optional = ("tiebreak_field", "layer", "acre_factor", "solver", "store", "willingness_field", "tile_size")
+    values = dict((name, CONVERTERS.get(name, str)(value)) for name, value in values.items()
+                  if value not in (None, "") or name in optional)
+    if values.get("method", "Greedy") not in SCORE_FIELDS:
+        raise ValueError("method must be one of {0}, not {1!r}".format(sorted(SCORE_FIELDS), values["method"]))
+    if values.get("solver") not in (None,) + SOLVER_METHODS:
+        raise ValueError("solver must be one of {0}, not {1!r}".format(SOLVER_METHODS, values["solver"]))
+    if values.get("tile_size") and values.get("store"):
+        raise ValueError("a tiled job builds its neighbor graph tile by tile and cannot use a store")
+    return Job(**values)
+
+
+def read_manifest(path):
+    '''jobs listed in a JSON file (a list of objects) or a CSV file (a header row of Job field names)'''
+
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() == ".json":
+            entries = json.load(f)
+        else:
+            entries = list(csv.DictReader(f))
+    return [make_job(entry) for entry in entries]
+
+
+def crs_acre_factor(path, layer=None):
+    '''square map units per acre from the linear units of a parcel file's projected CRS'''
+
+    with _open(path, layer) as source:
+        crs = source.crs
+    try:
+        meters = crs.linear_units_factor[1]
+    except Exception:
+        raise ValueError("{0} has no projected CRS to take the map units from; give the acre factor (square map "
+                         "units per acre) explicitly".format(path))
+    return SQM_PER_ACRE / meters ** 2
+
+
+def read_parcels(path, status_field, layer=None, tiebreak_field=None, geometry=True):
+    '''
+    FIDs, shapely geometries, status and tie-break values (or None) of a parcel file. The status is a masked
+    array: a missing status reads as -1, which leaves the parcel out of the analysis, and is masked. A null
+    geometry reads as an empty polygon, which has no area and leaves the parcel out of the analysis as well.
+    Without geometry only the attributes are read and the geometries are None.
+    '''
+
+    fids = []
+    geoms = []
+    status = []
+    missing = []
+    tiebreak = []
+    with _open(path, layer, ignore_geometry=not geometry) as source:
+        for feature in source:
+            properties = feature["properties"]
+            value = properties[status_field]
+            fids.append(int(feature["id"]))
+            if geometry:
+                geoms.append(_shape(feature["geometry"]))
+            status.append(-1 if value is None else value)
+            missing.append(value is None)
+            if tiebreak_field:
+                tiebreak.append(properties[tiebreak_field])
+    return (np.array(fids, dtype=np.int64), np.array(geoms, dtype=object) if geometry else None,
+            np.ma.masked_array(np.array(status, dtype=np.int64), mask=np.array(missing, dtype=bool)),
+            _tiebreak_values(tiebreak) if tiebreak_field else None)
+
+
+def read_willingness(path, willingness_field, layer=None):
+    '''
+    the willingness field of a parcel file: the probability, from 0 to 1, that the owner of each parcel
+    agrees to sell. A missing value reads as 1, a willing owner.
+    '''
+
+    willingness = []
+    with _open(path, layer, ignore_geometry=True) as source:
+        for feature in source:
+            value = feature["properties"][willingness_field]
+            willingness.append(1.0 if value is None else float(value))
+    willingness = np.array(willingness, dtype=float)
+    if len(willingness) and (willingness.min() < 0 or willingness.max() > 1):
+        raise ValueError("{0} must hold probabilities from 0 to 1".format(willingness_field))
+    return willingness
+
+
+def _tiebreak_values(values):
+    '''tie-break values as numbers, or as text when the field holds text; nulls rank lowest'''
+
+    if all(value is None or isinstance(value, (int, float)) for value in values):
+        return np.array([0 if value is None else value for value in values], dtype=float)
+    return np.array(["" if value is None else str(value) for value in values])
+
+
+def run_job(job):
+    '''
+    scores the parcels of a Job and writes them to its output. Like the tool, a simulating job preserves
+    num_preserve parcels in each of simulations - 1 rounds and then marks the top parcels of the last
+    round as preserved (status 1) next to the scores they had. A job with trajectories also writes the
+    Monte Carlo preservation frequency of simulations rounds of num_preserve parcels from the same starting
+    scores. Returns a JobResult.
+    '''
+
+    start = time.perf_counter()
+    acre_factor = job.acre_factor if job.acre_factor is not None else crs_acre_factor(job.parcels, job.layer)
+    solver = PatientSolver(job.solver, job.solver_tol, job.rank_patience) if job.solver else None
+    if job.store:
+        fids, _, status, tiebreak = read_parcels(job.parcels, job.status_field, job.layer, job.tiebreak_field,
+                                                 geometry=False)
+
+        def geometries():
+            return read_parcels(job.parcels, job.status_field, job.layer)[1]
+
+        store = open_store(job.store, geometries, status.data, fids, acre_factor, source=job.parcels,
+                           layer=job.layer)
+        scorer = store.scorer(job.jump, job.method, status.data, job.deprioritize, job.access_weight,
+                              job.average_neighb_weight, job.greedy_score_weight, job.averaging_iterations,
+                              geometries, solver, job.processes)
+    elif job.tile_size:
+        # geometry is only read a tile at a time, as in score_tiled(); the neighbor search is not split
+        fids, _, status, tiebreak = read_parcels(job.parcels, job.status_field, job.layer, job.tiebreak_field,
+                                                 geometry=False)
+        _, scorer = tiled_scorer(job.parcels, job.status_field, job.tile_size, job.method, job.jump,
+                                 job.deprioritize, job.access_weight, job.average_neighb_weight,
+                                 job.greedy_score_weight, job.averaging_iterations, acre_factor, job.layer, solver)
+    else:
+        fids, geoms, status, tiebreak = read_parcels(job.parcels, job.status_field, job.layer,
+                                                     job.tiebreak_field)
+        scorer = Scorer(geoms, status, job.method, job.jump, job.deprioritize, job.access_weight,
+                        job.average_neighb_weight, job.greedy_score_weight, job.averaging_iterations,
+                        acre_factor, solver, job.processes)
+    frequency = None
+    if job.trajectories:
+        willingness = (read_willingness(job.parcels, job.willingness_field, job.layer)
+                       if job.willingness_field else None)
+        frequency = monte_carlo(scorer, job.trajectories, max(int(job.simulations), 1), job.num_preserve,
+                                job.seed, willingness=willingness, processes=job.mc_processes).frequency
+    simulations = max(int(job.simulations), 1) if job.simulate else 1
+    simulate(scorer, simulations - 1, job.num_preserve, tiebreak)
+
+    # parcels that were not preserved keep their status, null included
+    result = np.ma.masked_array(np.where(scorer.preserved, 1, status.data), mask=status.mask.copy())
+    if job.simulate:
+        result[top_parcels(scorer.scores, scorer.unpreserved, job.num_preserve, scorer.weights, tiebreak)] = 1
+    fields = {job.status_field: result, SCORE_FIELDS[job.method]: scorer.scores}
+    if frequency is not None:
+        fields[FREQUENCY_FIELD] = frequency
+    write_scores(job.parcels, job.output, fields, fids, job.layer)
+    preserved = int(np.count_nonzero((result.data == 1) & (status.data != 1)))
+    return JobResult(job, len(fids), preserved, time.perf_counter() - start, None)
+
+
+def _run_safely(job):
+    '''run_job that reports a failure in its JobResult rather than raising it, so other jobs go on'''
+
+    start = time.perf_counter()
+    try:
+        return run_job(job)
+    except Exception:
+        return JobResult(job, 0, 0, time.perf_counter() - start, traceback.format_exc())
+
+
+def run_jobs(jobs, workers=None, callback=None):
+    '''
+    runs jobs on a pool of at most workers processes (all CPUs by default; 1 runs them in this process).
+    A failing job does not stop the others; its JobResult holds the traceback. Neither does a job whose worker
+    process dies: the jobs caught in the broken pool are run again, each in a process of its own, and the one
+    whose process dies again is reported as failed. callback, if given, is called with each JobResult as it
+    finishes. Returns the JobResults in the order of jobs.
+    '''
+
+    jobs = list(jobs)
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers == 1:
+        results = []
+        for job in jobs:
+            results.append(_run_safely(job))
+            if callback is not None:
+                callback(results[-1])
+        return results
+
+    results = [None] * len(jobs)
+
+    def finish(i, result):
+        results[i] = result
+        if callback is not None:
+            callback(result)
+
+    # a worker that dies (killed for memory, crashed) breaks the pool and every job still in it
+    broken = []
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = dict((pool.submit(_run_safely, job), i) for i, job in enumerate(jobs))
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                finish(futures[future], future.result())
+            except BrokenProcessPool:
+                broken.append(futures[future])
+
+    # which of them killed the worker is unknown, so each runs again in a process of its own
+    running = {}
+    broken.sort()
+    while broken or running:
+        while broken and len(running) < workers:
+            i = broken.pop(0)
+            pool = concurrent.futures.ProcessPoolExecutor(1)
+            running[pool.submit(_run_safely, jobs[i])] = i, pool
+        done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            i, pool = running.pop(future)
+            try:
+                result = future.result()
+            except BrokenProcessPool as error:
+                result = JobResult(jobs[i], 0, 0, 0.0, "the worker process running the job died: {0}".format(error))
+            pool.shutdown()
+            finish(i, result)
+    return results
@@ -0,0 +1,129 @@
+"""
+Blobs: groups of preserved parcels that lie within the jump distance of each other.
+
+Blobs are the connected components of the preserved parcels in the neighbor graph; the size of a blob is
+the summed acreage of its parcels, so no dissolved blob geometry is ever built.
+
+BlobSet keeps the blob label of every parcel (the index of one of its member parcels, -1 for parcels that
+are not preserved) together with the area of each blob, and merges blobs as parcels get preserved, so a
+simulation round only touches the blobs next to the parcels it preserves.
+"""
+
+import numpy as np
+
+from . import profiling
+
+
+def components(in_fid, near_fid, n):
+    '''
+    connected component of each of n nodes linked by the (in_fid, near_fid) pairs, labelled by the smallest
+    node index in the component. This is a vectorized union-find: every pass hooks the root with the
+    larger index under the smaller one and then compresses all paths to their roots.
+    '''
+
+    parent = np.arange(n)
+    while True:
+        roots_in, roots_near = parent[in_fid], parent[near_fid]
+        if np.array_equal(roots_in, roots_near):
+            return parent
+        np.minimum.at(parent, np.maximum(roots_in, roots_near), np.minimum(roots_in, roots_near))
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def find_blobs(graph, preserved, area):
+    '''
+    blob of every preserved parcel under the jump distance relation of the neighbor graph and the area of
+    each blob, the sum of its parcels' acreage. Returns a BlobSet.
+    '''
+
+    n = graph.shape[0]
+    preserved = np.asarray(preserved, dtype=np.intp)
+    with profiling.stage("blob aggregation", rows=len(preserved)) as counts:
+        position = np.full(n, -1, dtype=np.intp)
+        position[preserved] = np.arange(len(preserved))
+
+        # links between two preserved parcels
+        near = graph[preserved]
+        in_fid = np.repeat(np.arange(len(preserved)), np.diff(near.indptr))
+        near_fid = position[near.indices]
+        linked = near_fid >= 0
+
+        component = components(in_fid[linked], near_fid[linked], len(preserved))
+        component_area = np.bincount(component, weights=area[preserved], minlength=len(preserved))
+        blobs = BlobSet.from_components(n, preserved, component, component_area)
+        counts["blobs"] = len(blobs.members)
+        return blobs
+
+
+class BlobSet(object):
+    '''blob label and blob area of every parcel, merged incrementally (union by size)'''
+
+    def __init__(self, n):
+        self.blob_of = np.full(n, -1, dtype=np.intp)
+        self.area = np.zeros(n)
+        self.members = {}
+
+    @classmethod
+    def from_components(cls, n, parcels, component, component_area):
+        '''blob set of n parcels in which parcels[i] belongs to blob component[i] of component_area acres'''
+
+        blobs = cls(n)
+        if len(parcels) == 0:
+            return blobs
+        parcels = np.asarray(parcels, dtype=np.intp)
+        component = np.asarray(component)
+        order = np.argsort(component, kind="stable")
+        starts = np.r_[0, np.flatnonzero(np.diff(component[order])) + 1]
+        for members, area in zip(np.split(parcels[order], starts[1:]), component_area[component[order][starts]]):
+            label = members[0]
+            blobs.blob_of[members] = label
+            blobs.area[label] = area
+            blobs.members[label] = members
+        return blobs
+
+    def copy(self):
+        '''an independent copy of the blob set'''
+
+        other = BlobSet(0)
+        other.blob_of = self.blob_of.copy()
+        other.area = self.area.copy()
+        # member arrays are replaced, never changed in place, so they can be shared
+        other.members = dict(self.members)
+        return other
+
+    def labels(self):
+        '''labels of all blobs'''
+
+        return np.fromiter(self.members, dtype=np.intp, count=len(self.members))
+
+    def add(self, parcel, acres, neighbors):
+        '''
+        adds a newly preserved parcel of the given acreage, merging it with every blob among its neighbors.
+        Returns the label of the resulting blob.
+        '''
+
+        labels = np.unique(self.blob_of[neighbors])
+        labels = labels[labels >= 0]
+        if len(labels) == 0:
+            label = parcel
+            self.members[label] = np.array([parcel], dtype=np.intp)
+        else:
+            # relabel the smaller blobs into the largest one
+            sizes = [len(self.members[l]) for l in labels]
+            label = labels[int(np.argmax(sizes))]
+            for other in labels:
+                if other == label:
+                    continue
+                moved = self.members.pop(other)
+                self.blob_of[moved] = label
+                self.members[label] = np.concatenate([self.members[label], moved])
+                self.area[label] += self.area[other]
+                self.area[other] = 0
+            self.members[label] = np.append(self.members[label], parcel)
+        self.blob_of[parcel] = label
+        self.area[label] += acres
+        return label
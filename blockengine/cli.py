@@ -0,0 +1,97 @@
+"""
+Command line entry point: python -m blockengine.
+
+Scores one parcel file with the BlockGrower tool's parameters, or every job of a manifest on a pool of
+worker processes:
+
+    python -m blockengine parcels.shp Status scored.gpkg --method Patient --jump 100 --simulate \\
+        --simulations 3 --num-preserve 5
+    python -m blockengine parcels.shp Status scored.gpkg --simulations 10 --num-preserve 5 \\
+        --trajectories 1000 --willingness-field Willing --seed 1
+    python -m blockengine state.gpkg Status scored.parquet --jump 100 --tile-size 20000
+    python -m blockengine --manifest counties.csv --workers 8
+
+A manifest is a JSON list of objects or a CSV file whose header names the fields of blockengine.batch.Job
+(parcels, status_field, output, method, jump, ...). Exits with status 1 if any job failed.
+"""
+
+import argparse
+import sys
+
+from .batch import make_job, read_manifest, run_jobs
+from .scoring import METHODS, SQFT_PER_ACRE
+from .solver import SOLVER_METHODS
+
+
+def parser():
+    '''the argument parser of the command line'''
+
+    parser = argparse.ArgumentParser(prog="python -m blockengine",
+                                     description="Rank farmland parcels for preservation (Greedy or Patient).")
+    parser.add_argument("parcels", nargs="?", help="parcel file (anything fiona reads)")
+    parser.add_argument("status_field", nargs="?", help="preservation status field (1 preserved, 0 not)")
+    parser.add_argument("output", nargs="?", help="output file: .gpkg, .parquet score table, or a fiona format")
+    parser.add_argument("--manifest", help="JSON or CSV file of jobs to run instead of a single parcel file")
+    parser.add_argument("--workers", type=int, default=None, help="jobs run at once (all CPUs by default)")
+    parser.add_argument("--method", choices=METHODS, default="Greedy")
+    parser.add_argument("--jump", type=float, default=0, help="jump distance, in map units")
+    parser.add_argument("--deprioritize", action="store_true", help="deprioritize large blobs")
+    parser.add_argument("--access-weight", type=float, default=1)
+    parser.add_argument("--average-neighb-weight", type=float, default=2)
+    parser.add_argument("--greedy-score-weight", type=float, default=4)
+    parser.add_argument("--averaging-iterations", type=int, default=3)
+    parser.add_argument("--solver", choices=SOLVER_METHODS,
+                        help="evaluate Patient averaging with a PatientSolver (worth it for many iterations)")
+    parser.add_argument("--solver-tol", type=float, help="stop the iterate solver once the weights settle")
+    parser.add_argument("--rank-patience", type=int,
+                        help="stop the iterate solver once the ranking is stable for this many passes")
+    parser.add_argument("--simulate", action="store_true", help="simulate preservation")
+    parser.add_argument("--simulations", type=int, default=1, help="number of simulations")
+    parser.add_argument("--num-preserve", type=int, default=5, help="parcels to preserve per simulation")
+    parser.add_argument("--trajectories", type=int, default=0,
+                        help="also run this many Monte Carlo trajectories of --simulations rounds and write how "
+                        "often each parcel is preserved (PresrvFreq)")
+    parser.add_argument("--willingness-field",
+                        help="field with each owner's probability (0 to 1) of agreeing to sell, for Monte Carlo")
+    parser.add_argument("--seed", type=int, help="random seed of the Monte Carlo trajectories")
+    parser.add_argument("--mc-processes", type=int,
+                        help="worker processes for the Monte Carlo trajectories of each job (all CPUs by default)")
+    parser.add_argument("--tiebreak-field", help="field breaking ties between equal scores")
+    parser.add_argument("--layer", help="layer of a multi-layer parcel file")
+    parser.add_argument("--acre-factor", type=float,
+                        help="square map units per acre (by default from the parcel file's CRS; {0:g} for feet)"
+                        .format(SQFT_PER_ACRE))
+    parser.add_argument("--processes", type=int, default=1,
+                        help="worker processes for the neighbor search of each job (0 for all CPUs)")
+    parser.add_argument("--store", help="directory keeping the parcels' acreage and neighbor graphs between runs")
+    parser.add_argument("--tile-size", type=float,
+                        help="build the neighbor graph in square tiles of this size, in map units, reading only "
+                        "one tile's geometry at a time (for parcel files too large for memory)")
+    return parser
+
+
+def report(result):
+    '''prints one line about a finished job'''
+
+    if result.error:
+        print("FAILED {0} ({1:.1f} s)\n{2}".format(result.job.parcels, result.seconds, result.error))
+    else:
+        print("{0} -> {1}: {2} parcels, {3} preserved, {4:.1f} s".format(
+            result.job.parcels, result.job.output, result.parcels, result.preserved, result.seconds))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    if args.manifest:
+        jobs = read_manifest(args.manifest)
+    elif args.parcels and args.status_field and args.output:
+        options = dict(vars(args))
+        for name in ("manifest", "workers"):
+            del options[name]
+        jobs = [make_job(options)]
+    else:
+        parser().error("give parcels, status_field and output, or --manifest")
+
+    results = run_jobs(jobs, args.workers, report)
+    return 1 if any(result.error for result in results) else 0
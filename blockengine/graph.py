@@ -0,0 +1,146 @@
+"""
+Parcel adjacency within the jump distance.
+
+GenerateNearTable "ALL" is replaced by a spatial index query: an STRtree filters candidate pairs by bounding
+box and the exact polygon distance decides which of them lie within jump. The pairs are kept as a SciPy CSR
+matrix with a row per IN_FID and a column per NEAR_FID, so that the sums and means the script used to
+compute with JoinField and Statistics become sparse matrix-vector products on a graph that is built once.
+
+With processes, the source parcels are sorted along a Z-order curve and cut into spatially compact chunks
+that a pool of worker processes queries against one STRtree of the targets. Where processes are forked the
+tree is built once and inherited by every worker; elsewhere each worker builds its own copy.
+"""
+
+import multiprocessing
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+from . import profiling
+
+# chunks per worker process, so that dense chunks do not leave the other workers idle
+CHUNKS_PER_PROCESS = 4
+# fewest source parcels worth sending to a worker
+MIN_CHUNK = 5000
+
+# state of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _z_order(geoms):
+    '''order of the geometries along a Z-order (Morton) curve through their bounding box centers'''
+
+    bounds = shapely.bounds(geoms)
+    center = (bounds[:, :2] + bounds[:, 2:]) / 2
+    low = np.nanmin(center, axis=0)
+    span = np.maximum(np.nanmax(center, axis=0) - low, 1e-12)
+    cell = np.nan_to_num((center - low) / span * 65535).astype(np.uint64)
+    code = np.zeros(len(geoms), dtype=np.uint64)
+    for bit in range(16):
+        for axis in range(2):
+            code |= ((cell[:, axis] >> np.uint64(bit)) & np.uint64(1)) << np.uint64(2 * bit + axis)
+    return np.argsort(code, kind="stable")
+
+
+def _init_worker(source, target, jump, exclude_self, distances, tree=None):
+    '''sets up the spatial index a worker queries its chunks of source parcels against'''
+
+    if target is None:
+        target = source
+    _worker.update(source=source, target=target, jump=float(jump), exclude_self=exclude_self,
+                   distances=distances, tree=tree if tree is not None else shapely.STRtree(target))
+
+
+def _query(rows):
+    '''IN_FID, NEAR_FID and (if asked for) NEAR_DIST arrays of the given source parcels'''
+
+    source, target = _worker["source"], _worker["target"]
+    in_fid, near_fid = _worker["tree"].query(source[rows], predicate="dwithin", distance=_worker["jump"])
+    in_fid = rows[in_fid]
+    if _worker["exclude_self"]:
+        keep = in_fid != near_fid
+        in_fid, near_fid = in_fid[keep], near_fid[keep]
+    dist = shapely.distance(source[in_fid], target[near_fid]) if _worker["distances"] else None
+    return in_fid, near_fid, dist
+
+
+def _near(source, target, jump, exclude_self, distances, processes):
+    '''the near pairs of source and target, queried in this process or across a pool of processes'''
+
+    same = target is source
+    processes = min(processes or os.cpu_count() or 1, max(len(source) // MIN_CHUNK, 1))
+    if processes == 1:
+        _init_worker(source, None if same else target, jump, exclude_self, distances)
+        try:
+            return _query(np.arange(len(source)))
+        finally:
+            _worker.clear()
+
+    chunks = np.array_split(_z_order(source), processes * CHUNKS_PER_PROCESS)
+    initargs = (source, None if same else target, jump, exclude_self, distances)
+    try:
+        if multiprocessing.get_start_method() == "fork":
+            # forked workers inherit the index built here
+            _init_worker(*initargs)
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(_query, chunks)
+        else:
+            with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+                results = pool.map(_query, chunks)
+    finally:
+        _worker.clear()
+
+    in_fid, near_fid, dist = zip(*results)
+    # back into the IN_FID order of a single query
+    order = np.argsort(np.concatenate(in_fid), kind="stable")
+    in_fid, near_fid = np.concatenate(in_fid)[order], np.concatenate(near_fid)[order]
+    return in_fid, near_fid, np.concatenate(dist)[order] if distances else None
+
+
+def near_pairs(source, target, jump, exclude_self=False, processes=1):
+    '''
+    (IN_FID, NEAR_FID) index arrays of every source/target pair within jump, like GenerateNearTable "ALL".
+    processes splits the search across a pool of worker processes (None for all CPUs).
+    '''
+
+    if len(source) == 0 or len(target) == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty
+    in_fid, near_fid, dist = _near(source, target, jump, exclude_self, False, processes)
+    return in_fid, near_fid
+
+
+def near_table(source, target, jump, exclude_self=False, processes=1):
+    '''IN_FID, NEAR_FID and NEAR_DIST arrays of every source/target pair within jump'''
+
+    if len(source) == 0 or len(target) == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty, np.zeros(0)
+    return _near(source, target, jump, exclude_self, True, processes)
+
+
+def adjacency(in_fid, near_fid, shape):
+    '''CSR matrix with a 1 for every (IN_FID, NEAR_FID) pair'''
+
+    data = np.ones(len(in_fid))
+    graph = sp.csr_matrix((data, (in_fid, near_fid)), shape=shape)
+    graph.sum_duplicates()
+    return graph
+
+
+def neighbor_graph(source, jump, target=None, processes=1):
+    '''
+    adjacency of source parcels to target features within jump. Without target the graph links the source
+    parcels to each other, leaving out each parcel itself. processes is passed on to near_pairs.
+    '''
+
+    with profiling.stage("near table", rows=len(source), processes=processes or os.cpu_count()) as counts:
+        if target is None:
+            in_fid, near_fid = near_pairs(source, source, jump, exclude_self=True, processes=processes)
+            target = source
+        else:
+            in_fid, near_fid = near_pairs(source, target, jump, processes=processes)
+        counts["pairs"] = len(in_fid)
+        return adjacency(in_fid, near_fid, (len(source), len(target)))
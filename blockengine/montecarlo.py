@@ -0,0 +1,116 @@
+"""
+Monte Carlo simulation: many stochastic Simulate trajectories run in parallel.
+
+Every trajectory starts from the same scored parcels and, for a number of rounds, preserves parcels drawn
+at random (weighted by score, optionally filtered by landowner willingness) before re-scoring. The
+trajectories run in a multiprocessing pool; the neighbor graph is placed once in shared memory and every
+worker maps it read-only, so only the small per-parcel arrays are copied into each worker.
+"""
+
+import collections
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import scipy.sparse as sp
+
+from .simulate import random_parcels
+
+MonteCarloResult = collections.namedtuple("MonteCarloResult", ["frequency", "largest_blob", "blob_areas"])
+
+# state of a worker process, set up once by _init_worker
+_worker = {}
+
+
+def _share(array):
+    '''copies an array into a new shared memory block; returns the block and a description to attach it'''
+
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[:] = array
+    return block, (block.name, array.dtype.str, array.shape)
+
+
+def _attach(description):
+    '''attaches to a shared memory block; returns the block and the array it holds'''
+
+    name, dtype, shape = description
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype, buffer=block.buf)
+
+
+def _init_worker(scorer, graph_shape, shared, options):
+    '''rebuilds the scorer of a worker around the shared neighbor graph'''
+
+    blocks = []
+    arrays = []
+    for description in shared:
+        block, array = _attach(description)
+        blocks.append(block)
+        arrays.append(array)
+    data, indices, indptr = arrays
+    scorer.graph = sp.csr_matrix((data, indices, indptr), shape=graph_shape, copy=False)
+    _worker.update(scorer=scorer, blocks=blocks, options=options)
+
+
+def _trajectory(seed):
+    '''runs one trajectory; returns the parcels it preserved and the areas of its final blobs'''
+
+    scorer = _worker["scorer"].copy()
+    rounds, num_preserve, weighted, willingness = _worker["options"]
+    rng = np.random.default_rng(seed)
+    preserved = []
+    for i in range(rounds):
+        parcels = random_parcels(scorer.scores, scorer.unpreserved, num_preserve, rng, weighted, willingness)
+        scorer.preserve(parcels)
+        preserved.append(parcels)
+    blob_areas = np.sort(scorer.blobs.area[scorer.blobs.labels()])[::-1]
+    return np.concatenate(preserved) if preserved else np.zeros(0, dtype=np.intp), blob_areas
+
+
+def monte_carlo(scorer, trajectories, rounds, num_preserve, seed=None, weighted=True, willingness=None,
+                processes=None):
+    '''
+    runs the given number of stochastic simulation trajectories from a Scorer, each for rounds rounds of
+    num_preserve parcels, across a pool of processes (all CPUs by default; 1 runs them in this process).
+    Trajectory i uses the i-th seed spawned from seed, so results do not depend on the number of processes.
+
+    Returns a MonteCarloResult with the fraction of trajectories that end with each parcel preserved, the
+    largest final blob of each trajectory and the sorted final blob areas of each trajectory.
+    '''
+
+    seeds = np.random.SeedSequence(seed).spawn(trajectories)
+    if willingness is not None:
+        willingness = np.asarray(willingness, dtype=float)
+    options = (rounds, num_preserve, weighted, willingness)
+    processes = min(processes or os.cpu_count() or 1, max(trajectories, 1))
+
+    base = scorer.copy()
+    graph = base.graph
+    base.graph = None
+    blocks = []
+    try:
+        shared = []
+        for array in (graph.data, graph.indices, graph.indptr):
+            block, description = _share(np.ascontiguousarray(array))
+            blocks.append(block)
+            shared.append(description)
+        initargs = (base, graph.shape, shared, options)
+        if processes == 1:
+            _init_worker(*initargs)
+            results = [_trajectory(s) for s in seeds]
+        else:
+            with multiprocessing.Pool(processes, _init_worker, initargs) as pool:
+                results = pool.map(_trajectory, seeds)
+    finally:
+        _worker.clear()
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    counts = np.zeros(len(scorer.area))
+    for preserved, blob_areas in results:
+        counts[preserved] += 1
+    frequency = scorer.preserved + counts / max(trajectories, 1)
+    largest = np.array([areas[0] if len(areas) else 0.0 for preserved, areas in results])
+    return MonteCarloResult(frequency, largest, [areas for preserved, areas in results])
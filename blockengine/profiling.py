@@ -0,0 +1,139 @@
+"""
+Lightweight per-stage instrumentation.
+
+Code marks its stages with profiling.stage(name, **counts); counts such as rows or near pairs can be
+added to the yielded dict while the stage runs. Nothing is recorded unless a Tracer has been installed,
+so the stages cost next to nothing in normal runs. An installed Tracer records the wall time of every
+stage, its counts and the process's memory high-water mark after it (and, with memory=True, the peak of
+the memory traced by tracemalloc during the stage, which slows the run down). Tracer.summary() gives
+lines for a log such as arcpy.AddMessage, and Tracer.write_chrome_trace() a JSON file that opens in
+chrome://tracing or Perfetto.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_installed = []
+
+
+def peak_memory():
+    '''the process's peak resident memory in bytes, or None when it cannot be determined'''
+
+    if resource is not None:
+        # kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss)
+
+
+class Tracer(object):
+    '''records the stages run while it is installed'''
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.records = []
+        self.origin = time.perf_counter()
+        self._open = []
+
+    @contextlib.contextmanager
+    def stage(self, name, **counts):
+        '''times the enclosed block as a stage; yields counts, which the block may add to'''
+
+        entry = {"child_peak": 0}
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            if self._open:
+                self._open[-1]["child_peak"] = max(self._open[-1]["child_peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._open.append(entry)
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            seconds = time.perf_counter() - start
+            self._open.pop()
+            record = {"name": name, "start": start - self.origin, "seconds": seconds, "depth": len(self._open),
+                      "counts": counts, "peak_memory": peak_memory()}
+            if self.memory:
+                record["traced_peak"] = max(tracemalloc.get_traced_memory()[1], entry["child_peak"])
+                tracemalloc.reset_peak()
+                if self._open:
+                    self._open[-1]["child_peak"] = max(self._open[-1]["child_peak"], record["traced_peak"])
+            self.records.append(record)
+
+    def summary(self):
+        '''one line per stage, indented by nesting, in the order the stages started'''
+
+        lines = []
+        for record in sorted(self.records, key=lambda r: r["start"]):
+            counts = ", ".join("{0} {1}".format(key, value) for key, value in sorted(record["counts"].items()))
+            memory = ""
+            if record["peak_memory"] is not None:
+                memory = "  high-water {0:.0f} MB".format(record["peak_memory"] / 2.0 ** 20)
+            if "traced_peak" in record:
+                memory += "  traced peak {0:.1f} MB".format(record["traced_peak"] / 2.0 ** 20)
+            lines.append("{0}{1}: {2:.3f} s{3}{4}".format("  " * record["depth"], record["name"], record["seconds"],
+                                                        "  (" + counts + ")" if counts else "", memory))
+        return lines
+
+    def write_chrome_trace(self, path):
+        '''writes the stages as complete events of the Chrome trace event format'''
+
+        events = []
+        for record in self.records:
+            args = dict(record["counts"])
+            for key in ("peak_memory", "traced_peak"):
+                if record.get(key) is not None:
+                    args[key] = record[key]
+            events.append({"name": record["name"], "ph": "X", "pid": os.getpid(), "tid": 0,
+                           "ts": record["start"] * 1e6, "dur": record["seconds"] * 1e6, "args": args})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=float)
+
+
+def install(tracer):
+    '''makes tracer record all stages until it is uninstalled'''
+
+    _installed.append(tracer)
+
+
+def uninstall(tracer):
+    _installed.remove(tracer)
+
+
+@contextlib.contextmanager
+def installed(tracer):
+    '''installs tracer for the enclosed block; a tracer of None records nothing'''
+
+    if tracer is not None:
+        install(tracer)
+    try:
+        yield tracer
+    finally:
+        if tracer is not None:
+            uninstall(tracer)
+
+
+@contextlib.contextmanager
+def stage(name, **counts):
+    '''marks the enclosed block as a stage of the installed tracer, if any; yields the counts dict'''
+
+    if not _installed:
+        yield counts
+        return
+    with _installed[-1].stage(name, **counts) as counts:
+        yield counts
@@ -0,0 +1,345 @@
+"""
+Vectorized Greedy and Patient scoring of farmland parcels.
+
+This module holds the arithmetic of BlockGrower without any arcpy dependency. Parcels are passed in as
+shapely geometries (or WKB), preservation status as an array of 0/1 values, and every interim field that
+the ArcToolbox script used to write to the attribute table (POLY_AREA, WeightedAr, SUM_WEIGHT, CombndAcre,
+GreedyWght, NeighbArea, COUNT_NEAR, AvgNeighSz, PatientWgt, LocalValue) is returned as a NumPy array
+aligned with the input parcels, next to the final GreedyScr or PatientScr.
+"""
+
+import copy
+
+import numpy as np
+import shapely
+
+from . import profiling
+from .blobs import find_blobs
+from .graph import neighbor_graph
+from .solver import PatientSolver
+
+# square map units per acre for the common projected units
+SQFT_PER_ACRE = 43560.0
+SQM_PER_ACRE = 4046.8564224
+
+# blob size thresholds (acres) and the factors applied when large blobs are deprioritized
+LARGE_BLOB = 500
+MEDIUM_BLOB = 250
+FACTOR500 = 0
+FACTOR250 = 0.5
+
+METHODS = ("Greedy", "Patient")
+SCORE_FIELDS = {"Greedy": "GreedyScr", "Patient": "PatientScr"}
+
+# most Patient averaging passes re-scored incrementally; the pass history costs 8 bytes per parcel and pass
+# (and is copied with every Scorer), so more passes are evaluated by a PatientSolver instead
+HISTORY_PASSES = 20
+
+
+def as_geometries(parcels):
+    '''returns a NumPy object array of shapely geometries from geometries or WKB'''
+
+    geoms = np.asarray(parcels, dtype=object)
+    if geoms.size and isinstance(geoms.flat[0], (bytes, bytearray, memoryview)):
+        geoms = shapely.from_wkb([bytes(g) for g in geoms])
+    return geoms
+
+
+def acreage(geoms, acre_factor=SQFT_PER_ACRE):
+    '''area of each parcel in acres (POLY_AREA)'''
+
+    return shapely.area(geoms) / float(acre_factor)
+
+
+def translate(values, newMin=1, newMax=100):
+    '''maps an array of values to the newMin-newMax range; a constant array maps to newMax'''
+
+    values = np.asarray(values, dtype=float)
+    if values.size == 0:
+        return values
+    oldMin = values.min()
+    leftSpan = values.max() - oldMin
+    if leftSpan == 0:
+        return np.full(values.shape, float(newMax))
+    return newMin + (values - oldMin) / leftSpan * (newMax - newMin)
+
+
+def to_score(values):
+    '''translates weights to the 1-100 INTEGER score stored in GreedyScr/PatientScr (rounded half up)'''
+
+    return np.floor(translate(values) + 0.5).astype(np.int32)
+
+
+def weighted_area(area, deprioritize=False):
+    '''blob size after applying the large blob deprioritization factors (WeightedAr)'''
+
+    area = np.asarray(area, dtype=float)
+    if not deprioritize:
+        return area.copy()
+    return np.where(area >= LARGE_BLOB, area * FACTOR500, np.where(area >= MEDIUM_BLOB, area * FACTOR250, area))
+
+
+def greedy_weights(area, sum_weight):
+    '''greedy weight of each unpreserved parcel from its own acreage and the nearby blob area'''
+
+    combined = sum_weight + area
+    # parcels that touch no blob only count their own size
+    return combined, np.where(sum_weight == 0, area, combined + area)
+
+
+def _neighbors(graph, rows, mask):
+    '''the parcels in mask that neighbor any of rows'''
+
+    near = np.unique(graph[rows].indices)
+    return near[mask[near]]
+
+
+class Scorer(object):
+    '''
+    Greedy or Patient scores of a set of parcels that are kept up to date as parcels get preserved.
+
+    The neighbor graph of all parcels is built once. preserve() merges the newly preserved parcels into
+    their blobs and re-scores only the unpreserved parcels whose weights can change: the neighbors of the
+    changed blobs and, for the Patient method, everything within AveragingIterations steps of those.
+    With a PatientSolver, Patient averaging is instead evaluated by the solver for all parcels, and with
+    processes the neighbor search is split across a pool of worker processes.
+
+    The incremental update keeps the patient weight of every parcel after every pass, (AveragingIterations
+    + 1) * 8 bytes per parcel, which copy() duplicates for every Monte Carlo trajectory and sweep point.
+    Above HISTORY_PASSES passes a Scorer without a solver therefore uses PatientSolver("iterate"), which
+    keeps two rows and gives the same weights.
+    '''
+
+    def __init__(self, parcels, status, method="Greedy", jump=0, deprioritize=False, access_weight=1,
+                 average_neighb_weight=2, greedy_score_weight=4, averaging_iterations=3,
+                 acre_factor=SQFT_PER_ACRE, solver=None, processes=1):
+
+        with profiling.stage("parcel acreage") as counts:
+            geoms = as_geometries(parcels)
+            area = acreage(geoms, acre_factor)
+            counts["rows"] = len(geoms)
+        self._setup(area, neighbor_graph(geoms, jump, processes=processes), status, method, deprioritize, access_weight,
+                    average_neighb_weight, greedy_score_weight, averaging_iterations, solver)
+
+    @classmethod
+    def from_graph(cls, area, graph, status, method="Greedy", deprioritize=False, access_weight=1,
+                   average_neighb_weight=2, greedy_score_weight=4, averaging_iterations=3, solver=None):
+        '''scores parcels whose acreage and jump distance neighbor graph are already known'''
+
+        scorer = cls.__new__(cls)
+        scorer._setup(np.asarray(area, dtype=float), graph, status, method, deprioritize, access_weight,
+                      average_neighb_weight, greedy_score_weight, averaging_iterations, solver)
+        return scorer
+
+    def _setup(self, area, graph, status, method, deprioritize, access_weight, average_neighb_weight,
+               greedy_score_weight, averaging_iterations, solver):
+
+        if method not in METHODS:
+            raise ValueError("method must be one of {0}, not {1!r}".format(METHODS, method))
+        status = np.asarray(status)
+        if status.shape != area.shape or graph.shape != area.shape * 2:
+            raise ValueError("status and neighbor graph must have one entry per parcel")
+
+        self.method = method
+        self.deprioritize = deprioritize
+        self.access_weight = access_weight
+        self.average_neighb_weight = average_neighb_weight
+        self.greedy_score_weight = greedy_score_weight
+        self.averaging_iterations = int(averaging_iterations)
+        if solver is None and method == "Patient" and self.averaging_iterations > HISTORY_PASSES:
+            solver = PatientSolver("iterate")
+        self.solver = solver
+
+        n = len(area)
+        self.area = area
+        self.preserved = status == 1
+        # parcels with any other status are left out of the analysis, like the script's selections did, and so
+        # are parcels without area (a null or empty geometry), which have nothing to preserve
+        self.unpreserved = (status == 0) & (area > 0)
+        self.graph = graph
+
+        # calculate "blob" size of preserved parcels
+        self.blobs = find_blobs(self.graph, np.flatnonzero(self.preserved), self.area)
+
+        self.sum_weight = np.zeros(n)
+        self.combined = np.zeros(n)
+        self.greedy = np.zeros(n)
+        if method == "Patient":
+            self.neighb_area = np.zeros(n)
+            self.count = np.zeros(n)
+            self.avg_size = np.zeros(n)
+            # patient weight of every parcel after each averaging pass, row 0 holding the starting weight; a
+            # solver only keeps the starting and the final weight
+            passes = 1 if solver is not None else self.averaging_iterations
+            self.history = np.zeros((passes + 1, n))
+            self.local = np.zeros(n)
+        self.scores = np.zeros(n, dtype=np.int32)
+
+        unpreserved = np.flatnonzero(self.unpreserved)
+        with profiling.stage("greedy weighting", rows=len(unpreserved)):
+            self._update_greedy(unpreserved)
+        if method == "Patient":
+            with profiling.stage("patient averaging", rows=len(unpreserved), iterations=self.averaging_iterations):
+                self._update_patient(unpreserved)
+        self._update_scores()
+
+    def copy(self):
+        '''an independent copy of the scores that shares the read-only neighbor graph and acreage'''
+
+        other = copy.copy(self)
+        other.blobs = self.blobs.copy()
+        other.preserved = self.preserved.copy()
+        other.unpreserved = self.unpreserved.copy()
+        other.scores = self.scores.copy()
+        for name in ("sum_weight", "combined", "greedy", "neighb_area", "count", "avg_size", "history", "local"):
+            if hasattr(self, name):
+                setattr(other, name, getattr(self, name).copy())
+        return other
+
+    def reweight(self, access_weight, average_neighb_weight, greedy_score_weight):
+        '''a copy scored with other Patient weights; blobs and greedy weights are reused as they are'''
+
+        if self.method != "Patient":
+            raise ValueError("only Patient scores depend on the weights")
+        other = self.copy()
+        other.access_weight = access_weight
+        other.average_neighb_weight = average_neighb_weight
+        other.greedy_score_weight = greedy_score_weight
+        other._update_patient(np.flatnonzero(other.unpreserved))
+        other._update_scores()
+        return other
+
+    @property
+    def weights(self):
+        '''the raw weights behind the scores: greedy weights or patient local values'''
+
+        return self.greedy if self.method == "Greedy" else self.local
+
+    def blob_weight(self, labels):
+        '''weighted area (WeightedAr) of the blobs with the given labels'''
+
+        return weighted_area(self.blobs.area[labels], self.deprioritize)
+
+    def _update_greedy(self, rows):
+        '''recomputes nearby blob area and greedy weight of the given unpreserved parcels'''
+
+        near = self.graph[rows]
+        owner = np.repeat(np.arange(len(rows)), np.diff(near.indptr))
+        labels = self.blobs.blob_of[near.indices]
+        touching = labels >= 0
+
+        # every blob counts once, however many of its parcels are within reach
+        pairs = np.unique(owner[touching] * len(self.area) + labels[touching])
+        owner, labels = np.divmod(pairs, len(self.area))
+        sum_weight = np.bincount(owner, weights=self.blob_weight(labels), minlength=len(rows))
+
+        self.sum_weight[rows] = sum_weight
+        self.combined[rows], self.greedy[rows] = greedy_weights(self.area[rows], sum_weight)
+
+    def _update_patient(self, rows):
+        '''recomputes the patient weights of the given unpreserved parcels and of everything they reach'''
+
+        mask = self.unpreserved.astype(float)
+        # when every unpreserved parcel is recomputed, plain mat-vecs beat copying the rows out of the graph
+        full = len(rows) == np.count_nonzero(self.unpreserved)
+
+        def spread(values, rows):
+            return (self.graph @ values)[rows] if full else self.graph[rows] @ values
+
+        self.count[rows] = spread(mask, rows)
+        self.neighb_area[rows] = spread(self.area * mask, rows)
+        self.avg_size[rows] = np.divide(self.neighb_area[rows], self.count[rows], out=np.zeros(len(rows)),
+                                        where=self.count[rows] > 0)
+        self.history[0, rows] = (self.neighb_area[rows] * self.access_weight
+                                 + self.avg_size[rows] * self.average_neighb_weight
+                                 + self.greedy[rows] * self.greedy_score_weight)
+
+        if self.solver is not None:
+            # the solver has no per-pass history to update, so it averages all unpreserved parcels again
+            active = np.flatnonzero(self.unpreserved)
+            result = self.solver.solve(self.history[0, active], self.graph[active][:, active],
+                                       self.averaging_iterations)
+            self.history[1] = 0
+            self.history[1, active] = result.patient
+            self.local[:] = 0
+            self.local[active] = result.local
+            return
+
+        # each averaging pass spreads a change one more step through the unpreserved parcels
+        for i in range(1, self.averaging_iterations + 1):
+            if not full:
+                rows = np.union1d(rows, _neighbors(self.graph, rows, self.unpreserved))
+            count = self.count[rows]
+            total = spread(self.history[i - 1] * mask, rows)
+            mean = np.divide(total, count, out=np.zeros(len(rows)), where=count > 0)
+            self.history[i, rows] = (mean + self.history[i - 1, rows]) / 2
+        self.local[rows] = self.history[1:, rows].sum(axis=0)
+
+    def _update_scores(self):
+        '''maps the greedy weights or local values of the unpreserved parcels to 1-100 scores'''
+
+        self.scores[:] = 0
+        self.scores[self.unpreserved] = to_score(self.weights[self.unpreserved])
+
+    def preserve(self, parcels):
+        '''changes the status of the given unpreserved parcels to preserved and re-scores their surroundings'''
+
+        parcels = np.unique(np.asarray(parcels, dtype=np.intp))
+        parcels = parcels[self.unpreserved[parcels]]
+        if len(parcels) == 0:
+            return
+        with profiling.stage("rescore", rows=len(parcels)) as counts:
+            self.unpreserved[parcels] = False
+            self.preserved[parcels] = True
+            for values in self._fields():
+                values[..., parcels] = 0
+
+            # merge the new parcels into their blobs
+            indptr, indices = self.graph.indptr, self.graph.indices
+            for parcel in parcels:
+                self.blobs.add(parcel, self.area[parcel], indices[indptr[parcel]:indptr[parcel + 1]])
+            changed = np.unique(self.blobs.blob_of[parcels])
+            members = np.concatenate([self.blobs.members[label] for label in changed])
+
+            # only the parcels next to a changed blob see different blob areas or neighbor sets
+            rows = _neighbors(self.graph, members, self.unpreserved)
+            counts["rescored"] = len(rows)
+            self._update_greedy(rows)
+            if self.method == "Patient":
+                self._update_patient(rows)
+            self._update_scores()
+
+    def _fields(self):
+        '''the per-parcel arrays that only hold values for unpreserved parcels'''
+
+        fields = [self.sum_weight, self.combined, self.greedy]
+        if self.method == "Patient":
+            fields += [self.neighb_area, self.count, self.avg_size, self.history, self.local]
+        return fields
+
+    def fields(self):
+        '''dict of arrays aligned with the parcels, keyed by the BlockGrower field names'''
+
+        weighted = np.zeros(len(self.area))
+        preserved = np.flatnonzero(self.preserved)
+        weighted[preserved] = self.blob_weight(self.blobs.blob_of[preserved])
+        result = {"POLY_AREA": self.area, "WeightedAr": weighted, "SUM_WEIGHT": self.sum_weight,
+                  "CombndAcre": self.combined, "GreedyWght": self.greedy}
+        if self.method == "Patient":
+            result.update(NeighbArea=self.neighb_area, COUNT_NEAR=self.count.astype(np.intp),
+                          AvgNeighSz=self.avg_size, PatientWgt=self.history[-1], LocalValue=self.local)
+        result[SCORE_FIELDS[self.method]] = self.scores
+        return dict((name, np.array(values)) for name, values in result.items())
+
+
+def score_parcels(parcels, status, method="Greedy", jump=0, deprioritize=False, access_weight=1,
+                  average_neighb_weight=2, greedy_score_weight=4, averaging_iterations=3,
+                  acre_factor=SQFT_PER_ACRE, solver=None, processes=1):
+    '''
+    scores every unpreserved parcel (status 0) with the Greedy or Patient method. Returns a dict of arrays
+    aligned with parcels keyed by the BlockGrower field names; preserved parcels score 0. A PatientSolver
+    may be given to evaluate the Patient averaging passes, and processes to split the neighbor search.
+    '''
+
+    return Scorer(parcels, status, method, jump, deprioritize, access_weight, average_neighb_weight,
+                  greedy_score_weight, averaging_iterations, acre_factor, solver, processes).fields()
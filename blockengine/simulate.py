@@ -0,0 +1,84 @@
+"""
+The Simulate loop of BlockGrower: repeatedly preserve the highest scoring parcels and re-score.
+"""
+
+import numpy as np
+
+from . import profiling
+
+
+def top_parcels(scores, candidates, num_preserve, weights=None, tiebreak=None):
+    '''
+    indices of exactly num_preserve candidates (all of them when fewer remain) with the highest scores, in
+    rank order. Ties are broken by the higher raw weight, then the higher tiebreak value (the later one in
+    sort order for text), then the lower index (FID), so the selection is reproducible.
+    '''
+
+    candidates = np.flatnonzero(candidates)
+    k = min(int(num_preserve), len(candidates))
+    if k <= 0:
+        return candidates[:0]
+
+    # partial selection of the k-th highest score; only candidates at or above it need ranking
+    values = scores[candidates]
+    kth = np.partition(values, len(values) - k)[len(values) - k]
+    candidates = candidates[values >= kth]
+
+    keys = [candidates]
+    if tiebreak is not None:
+        tiebreak = np.asarray(tiebreak)[candidates]
+        if not np.issubdtype(tiebreak.dtype, np.number):
+            # text (or other non-numeric) tie-break values rank by their sort order
+            tiebreak = np.unique(tiebreak, return_inverse=True)[1].ravel()
+        keys.append(-tiebreak)
+    if weights is not None:
+        keys.append(-np.asarray(weights)[candidates])
+    keys.append(-scores[candidates])
+    return candidates[np.lexsort(keys)[:k]]
+
+
+def random_parcels(scores, candidates, num_preserve, rng, weighted=True, willingness=None):
+    '''
+    indices of num_preserve parcels drawn at random among the candidates. With weighted, the chance of a
+    parcel is proportional to its score (weighted sampling without replacement); otherwise the highest
+    scores are taken with ties broken at random. With willingness, an array of probabilities that the owner
+    of each parcel agrees to sell, the parcels whose owners refuse this round are skipped.
+    '''
+
+    candidates = np.flatnonzero(candidates)
+    if willingness is not None:
+        candidates = candidates[rng.random(len(candidates)) < willingness[candidates]]
+    if len(candidates) <= num_preserve:
+        return candidates
+    u = rng.random(len(candidates))
+    if weighted:
+        # Efraimidis-Spirakis keys: the k largest log(u) / w are a weighted sample of size k
+        keys = np.log(u) / np.maximum(scores[candidates], 1e-12)
+    else:
+        keys = scores[candidates] + u
+    return candidates[np.argpartition(-keys, num_preserve - 1)[:num_preserve]]
+
+
+def simulate(scorer, rounds, num_preserve, tiebreak=None, batch=None):
+    '''
+    runs the given number of simulation rounds on a Scorer, preserving the top num_preserve parcels each
+    round. With batch, the parcels of a round are picked batch at a time and the scores updated in between
+    (batch=1 re-scores after every single pick). Returns the parcels preserved in every round.
+    '''
+
+    preserved = []
+    for i in range(rounds):
+        picked = []
+        remaining = num_preserve
+        with profiling.stage("simulation round", round=i + 1) as counts:
+            while remaining > 0:
+                parcels = top_parcels(scorer.scores, scorer.unpreserved, min(batch or remaining, remaining),
+                                      scorer.weights, tiebreak)
+                if len(parcels) == 0:
+                    break
+                scorer.preserve(parcels)
+                picked.append(parcels)
+                remaining -= len(parcels)
+            preserved.append(np.concatenate(picked) if picked else np.zeros(0, dtype=np.intp))
+            counts["rows"] = len(preserved[-1])
+    return preserved
@@ -0,0 +1,138 @@
+"""
+Patient averaging as sparse diffusion over the neighbor graph of the unpreserved parcels.
+
+One averaging pass is PatientWgt <- (A PatientWgt), with A = (I + M) / 2 and M the row-normalized
+neighbor graph (the neighbor mean, 0 for parcels without neighbors), and LocalValue accumulates the
+result of every pass. PatientSolver offers two ways to evaluate AveragingIterations passes:
+
+"iterate"       the passes themselves as sparse mat-vecs, optionally stopping early once the patient
+                weights no longer change by more than tol (relative, L-infinity) or once the ranking has
+                been stable for rank_patience passes; the remaining passes are then added as
+                (remaining passes) * PatientWgt.
+"krylov"        the accumulated sum, a polynomial of degree AveragingIterations in A, evaluated on a Lanczos
+                basis of the symmetrized graph. The basis stops growing once the result changes by less
+                than krylov_tol, which for many iterations takes far fewer mat-vecs than the passes
+                themselves; parcels without neighbors are evaluated exactly.
+"""
+
+import collections
+
+import numpy as np
+import scipy.linalg
+import scipy.sparse as sp
+
+SolverResult = collections.namedtuple("SolverResult", ["patient", "local", "iterations", "converged"])
+
+SOLVER_METHODS = ("iterate", "krylov")
+
+
+class PatientSolver(object):
+    '''evaluates the Patient averaging passes; see the module documentation for the methods'''
+
+    # Lanczos steps between two convergence checks of the krylov method, and the most it takes
+    KRYLOV_CHECK = 5
+    KRYLOV_STEPS = 200
+
+    def __init__(self, method="iterate", tol=None, rank_patience=None, krylov_tol=1e-8):
+        if method not in SOLVER_METHODS:
+            raise ValueError("method must be one of {0}, not {1!r}".format(SOLVER_METHODS, method))
+        self.method = method
+        self.tol = tol
+        self.rank_patience = rank_patience
+        self.krylov_tol = krylov_tol
+
+    def solve(self, patient, graph, iterations):
+        '''
+        the patient weights after the given number of averaging passes over a symmetric neighbor graph and
+        the local values accumulated on the way. Returns a SolverResult.
+        '''
+
+        patient = np.asarray(patient, dtype=float)
+        if self.method == "krylov":
+            return self._krylov(patient, graph, int(iterations))
+        return self._iterate(patient, graph, int(iterations))
+
+    def _iterate(self, patient, graph, iterations):
+        count = np.diff(graph.indptr)
+        mean = sp.diags(np.divide(1.0, count, out=np.zeros(len(count)), where=count > 0)) @ graph
+        local = np.zeros(len(patient))
+        last_rank = None
+        stable = 0
+        for i in range(1, iterations + 1):
+            previous = patient
+            patient = (mean @ patient + patient) / 2
+            local += patient
+            remaining = iterations - i
+            if remaining == 0:
+                break
+
+            if self.tol is not None:
+                scale = max(np.abs(patient).max(), np.finfo(float).tiny)
+                if np.abs(patient - previous).max() <= self.tol * scale:
+                    return SolverResult(patient, local + remaining * patient, i, True)
+
+            if self.rank_patience:
+                rank = np.argsort(local + remaining * patient, kind="stable")
+                stable = stable + 1 if last_rank is not None and np.array_equal(rank, last_rank) else 0
+                if stable >= self.rank_patience:
+                    return SolverResult(patient, local + remaining * patient, i, True)
+                last_rank = rank
+        return SolverResult(patient, local, iterations, False)
+
+    def _krylov(self, patient, graph, iterations):
+        count = np.diff(graph.indptr).astype(float)
+        isolated = count == 0
+
+        # parcels without neighbors halve their weight every pass
+        local = patient * (1 - 0.5 ** iterations)
+        final = patient * 0.5 ** iterations
+        connected = np.flatnonzero(~isolated)
+        if len(connected) == 0 or iterations == 0:
+            return SolverResult(final, local, iterations, True)
+
+        # A = D^-1/2 B D^1/2 with the symmetric B = (I + D^-1/2 W D^-1/2) / 2
+        root = np.sqrt(count[connected])
+        scaling = sp.diags(1 / root)
+        symmetric = scaling @ graph[connected][:, connected] @ scaling
+        u = root * patient[connected]
+        norm = np.linalg.norm(u)
+        if norm == 0:
+            return SolverResult(final, local, iterations, True)
+
+        # Lanczos with full reorthogonalization; the accumulated sum is sum(B^t) u for t = 1..iterations
+        steps = min(iterations + 1, self.KRYLOV_STEPS)
+        basis = np.empty((steps, len(u)))
+        basis[0] = u / norm
+        alpha = []
+        beta = []
+        converged = False
+        previous = None
+        for k in range(1, steps + 1):
+            q = basis[k - 1]
+            Q = basis[:k]
+            w = (q + symmetric @ q) / 2
+            alpha.append(q @ w)
+            w -= Q.T @ (Q @ w)
+            w -= Q.T @ (Q @ w)
+            beta.append(np.linalg.norm(w))
+            exhausted = beta[-1] <= 1e-12 * norm or k == iterations + 1
+            if k % self.KRYLOV_CHECK == 0 or exhausted or k == steps:
+                theta, vectors = scipy.linalg.eigh_tridiagonal(np.array(alpha), np.array(beta[:-1]))
+                theta = np.clip(theta, 0, 1)
+                power = theta ** iterations
+                near_one = np.isclose(theta, 1, rtol=0, atol=1e-12)
+                total = np.where(near_one, iterations, theta * (1 - power) / np.where(near_one, 1, 1 - theta))
+                coefficients = vectors @ (np.c_[total, power] * vectors[0][:, None])
+                approximation = norm * (Q.T @ coefficients)
+                if exhausted or (previous is not None and np.abs(approximation - previous).max() <=
+                                 self.krylov_tol * max(np.abs(approximation).max(), np.finfo(float).tiny)):
+                    converged = True
+                previous = approximation
+                if converged:
+                    break
+            if k < steps:
+                basis[k] = w / beta[-1]
+
+        local[connected] = previous[:, 0] / root
+        final[connected] = previous[:, 1] / root
+        return SolverResult(final, local, k, converged)
@@ -0,0 +1,306 @@
+"""
+Prepared parcel datasets: a directory of memory-mapped NumPy columns that persists between runs.
+
+    meta.json               parcel count, acre factor, geometry hash or source stamp and layer, prepared jumps
+    fid.npy                 FID of every parcel
+    area.npy                acreage (POLY_AREA) of every parcel
+    status.npy              preservation status of every parcel
+    graph_<jump>/           CSR neighbor graph within that jump: indptr.npy, indices.npy, data.npy
+
+A store prepared from in-memory parcels is validated by a geometry hash, a SHA-1 of the parcels' WKB in
+order, so it is rebuilt as soon as any parcel changes; that needs every geometry. A store prepared from a
+parcel file is instead validated by the file's source stamp (the size and modification time of the file,
+or of a shapefile's .shp and .shx) together with the layer and the parcel count, so a repeated run neither
+reads nor hashes any geometry, and two layers of one file never share a store. Columns and graphs are
+opened with mmap_mode="r": opening a store reads only meta.json, and repeated runs with other statuses or
+weights share the operating system's page cache.
+
+Several processes may share a store, e.g. batch jobs scoring one county with different weights. Every file
+is written under a temporary name and moved into place, so a reader never maps a half-written column, and
+preparing the store or adding a graph to meta.json happens under an exclusive lock on store.lock: the
+first process prepares the store while the others wait and then find it prepared.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import scipy.sparse as sp
+import shapely
+
+from .graph import neighbor_graph
+from .scoring import SQFT_PER_ACRE, Scorer, acreage, as_geometries
+
+FORMAT_VERSION = 2
+
+
+def geometry_hash(geoms):
+    '''SHA-1 hex digest of the WKB of the geometries, in order'''
+
+    digest = hashlib.sha1()
+    for wkb in shapely.to_wkb(geoms):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+def source_stamp(source):
+    '''
+    size and modification time of the files holding a parcel file's geometry: a shapefile's .shp and .shx,
+    every file of a folder dataset (file geodatabase), or else the file itself
+    '''
+
+    root, ext = os.path.splitext(source)
+    if ext.lower() == ".shp":
+        paths = [root + suffix for suffix in (ext, ".shx", ".SHX") if os.path.exists(root + suffix)]
+    elif os.path.isdir(source):
+        paths = sorted(os.path.join(source, name) for name in os.listdir(source))
+    else:
+        paths = [source]
+    stamp = []
+    for name in paths:
+        stat = os.stat(name)
+        stamp.append([os.path.basename(name), stat.st_size, stat.st_mtime_ns])
+    return stamp
+
+
+def _geometries(parcels):
+    # parcels may be a function that reads them, called only when geometry is needed
+    return as_geometries(parcels() if callable(parcels) else parcels)
+
+
+def _graph_dir(jump):
+    return "graph_{0:g}".format(float(jump))
+
+
+def _replace(filename, write, mode="wb"):
+    '''writes a file under a temporary name with write(file) and moves it into place in one step'''
+
+    fd, temp = tempfile.mkstemp(prefix=os.path.basename(filename) + ".", suffix=".tmp",
+                                dir=os.path.dirname(filename))
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(temp, filename)
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def _save(filename, array):
+    _replace(filename, lambda f: np.save(f, array))
+
+
+@contextlib.contextmanager
+def _locked(path):
+    '''
+    holds an exclusive lock on the store at path, waiting for other processes to release it. The operating
+    system releases the lock of a process that dies, so a crashed job never leaves the store locked.
+    '''
+
+    if not os.path.isdir(path):
+        os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "store.lock"), "a+b") as handle:
+        if os.name == "nt":
+            import msvcrt
+            handle.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds; keep waiting
+                    pass
+            try:
+                yield
+            finally:
+                handle.seek(0)
+                msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+
+
+def _read_meta(path):
+    '''the contents of meta.json, or None when the store has not been prepared'''
+
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        return None
+
+
+def _identity(meta):
+    # everything in meta.json that says which parcels the store holds, i.e. all but the prepared jumps
+    return dict((key, value) for key, value in meta.items() if key != "jumps")
+
+
+class ParcelStore(object):
+    '''a prepared parcel dataset on disk'''
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = _read_meta(path)
+        if self.meta is None:
+            raise IOError("{0} is not a prepared parcel store".format(path))
+        if self.meta.get("version") != FORMAT_VERSION:
+            raise ValueError("{0} is not a version {1} parcel store".format(path, FORMAT_VERSION))
+        self._graphs = {}
+
+    @classmethod
+    def prepare(cls, path, parcels, status, fids=None, acre_factor=SQFT_PER_ACRE, jumps=(), processes=1,
+                source=None, layer=None):
+        '''
+        writes the columns of the parcels (and the graphs for the given jumps, searched with processes
+        worker processes) to path and opens it. With source, the parcel file the parcels were read from, the
+        store is stamped with the file and layer rather than hashed.
+        '''
+
+        geoms = _geometries(parcels)
+        with _locked(path):
+            store = cls._prepare(path, geoms, status, fids, acre_factor, source, layer)
+        for jump in jumps:
+            store.graph(jump, geoms, processes)
+        return store
+
+    @classmethod
+    def _prepare(cls, path, geoms, status, fids, acre_factor, source, layer):
+        # the caller holds the lock
+        for name in os.listdir(path):
+            if name.startswith("graph_"):
+                for array in os.listdir(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name, array))
+                os.rmdir(os.path.join(path, name))
+        fids = np.arange(len(geoms)) if fids is None else np.asarray(fids)
+        _save(os.path.join(path, "fid.npy"), fids.astype(np.int64))
+        _save(os.path.join(path, "area.npy"), acreage(geoms, acre_factor))
+        _save(os.path.join(path, "status.npy"), np.asarray(status).astype(np.int64))
+
+        meta = {"version": FORMAT_VERSION, "count": len(geoms), "acre_factor": float(acre_factor), "jumps": [],
+                "geometry_hash": None if source is not None else geometry_hash(geoms),
+                "source_stamp": None if source is None else source_stamp(source),
+                "source_layer": None if source is None else layer}
+        cls._write_meta(path, meta)
+        return cls(path)
+
+    @staticmethod
+    def _write_meta(path, meta):
+        # meta.json is written last and replaced atomically, so a half-written store never looks valid
+        _replace(os.path.join(path, "meta.json"), lambda f: json.dump(meta, f, indent=1), "w")
+
+    def __len__(self):
+        return self.meta["count"]
+
+    def _column(self, name):
+        return np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r")
+
+    @property
+    def fids(self):
+        return self._column("fid")
+
+    @property
+    def area(self):
+        return self._column("area")
+
+    @property
+    def status(self):
+        return self._column("status")
+
+    def matches(self, parcels, acre_factor=SQFT_PER_ACRE):
+        '''whether the store was prepared from exactly these parcel geometries and acre factor'''
+
+        geoms = as_geometries(parcels)
+        return (len(geoms) == len(self) and float(acre_factor) == self.meta["acre_factor"]
+                and geometry_hash(geoms) == self.meta["geometry_hash"])
+
+    def matches_source(self, source, acre_factor=SQFT_PER_ACRE, layer=None, count=None):
+        '''
+        whether the store was prepared from this layer of the parcel file source, unchanged since, with this
+        acre factor (and count parcels, when given)
+        '''
+
+        return (float(acre_factor) == self.meta["acre_factor"] and self.meta.get("source_layer") == layer
+                and (count is None or count == len(self))
+                and self.meta.get("source_stamp") == source_stamp(source))
+
+    def has_graph(self, jump):
+        return float(jump) in self.meta["jumps"]
+
+    def graph(self, jump, parcels=None, processes=1):
+        '''
+        the neighbor graph within jump, memory-mapped from the store. A graph that has not been prepared yet
+        is built from the parcels (or a function returning them), which must then be given, and saved;
+        processes splits its neighbor search.
+        '''
+
+        jump = float(jump)
+        if jump in self._graphs:
+            return self._graphs[jump]
+        folder = os.path.join(self.path, _graph_dir(jump))
+        if self.has_graph(jump):
+            arrays = [np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+                      for name in ("data", "indices", "indptr")]
+            graph = sp.csr_matrix(tuple(arrays), shape=(len(self), len(self)), copy=False)
+        else:
+            if parcels is None:
+                raise KeyError("no neighbor graph for jump {0:g} in {1}; pass the parcels to build it"
+                               .format(jump, self.path))
+            graph = neighbor_graph(_geometries(parcels), jump, processes=processes)
+            with _locked(self.path):
+                # another process may have added graphs, or prepared the store from other parcels, meanwhile
+                meta = _read_meta(self.path)
+                if meta is not None and _identity(meta) == _identity(self.meta):
+                    if not os.path.isdir(folder):
+                        os.makedirs(folder)
+                    for name in ("data", "indices", "indptr"):
+                        _save(os.path.join(folder, name + ".npy"), getattr(graph, name))
+                    meta["jumps"] = sorted(set(meta["jumps"]) | {jump})
+                    self._write_meta(self.path, meta)
+                    self.meta = meta
+        self._graphs[jump] = graph
+        return graph
+
+    def scorer(self, jump, method="Greedy", status=None, deprioritize=False, access_weight=1,
+               average_neighb_weight=2, greedy_score_weight=4, averaging_iterations=3, parcels=None, solver=None,
+               processes=1):
+        '''Scorer of the stored parcels, with the stored status unless another status array is given'''
+
+        return Scorer.from_graph(self.area, self.graph(jump, parcels, processes),
+                                 self.status if status is None else status, method, deprioritize, access_weight,
+                                 average_neighb_weight, greedy_score_weight, averaging_iterations, solver)
+
+
+def open_store(path, parcels, status, fids=None, acre_factor=SQFT_PER_ACRE, source=None, layer=None):
+    '''
+    opens the store at path if it was prepared from the same parcels, and (re)prepares it from the parcels
+    otherwise. The stored status is that of the first preparation and is never rewritten, as other
+    processes may be reading it; pass the current status to ParcelStore.scorer().
+
+    Without source the parcels are compared by their geometry hash. With source, the parcel file they come
+    from, and layer, the layer they were read from, only the file's source stamp, the layer and the number
+    of fids are compared, and parcels may be a function that reads them, which is then only called when the
+    store has to be (re)prepared.
+    '''
+
+    # checked and prepared under the lock, so of several processes opening a new store only one prepares it
+    with _locked(path):
+        try:
+            store = ParcelStore(path)
+        except (IOError, OSError, ValueError):
+            store = None
+        if source is not None:
+            count = None if fids is None else len(fids)
+            matches = store is not None and store.matches_source(source, acre_factor, layer, count)
+        else:
+            matches = store is not None and store.matches(parcels, acre_factor)
+        if matches:
+            return store
+        return ParcelStore._prepare(path, _geometries(parcels), status, fids, acre_factor, source, layer)
@@ -0,0 +1,109 @@
+"""
+Parameter sweeps over jump distance and Patient weights.
+
+The near pairs and their distances are computed once, for the largest jump. The graph for any smaller
+jump is derived by keeping the pairs within that distance, and derived graphs are kept in an LRU cache
+bounded by a memory budget. Per jump distance the blobs and greedy weights are computed once; as Patient
+averaging is linear in the three weights, it is run once per weight on its own and every weight
+combination is a weighted sum of those three runs.
+"""
+
+import collections
+import itertools
+
+import numpy as np
+import scipy.sparse as sp
+
+from .graph import near_table
+from .scoring import METHODS, SQFT_PER_ACRE, Scorer, acreage, as_geometries, to_score
+
+SweepPoint = collections.namedtuple("SweepPoint", ["jump", "access_weight", "average_neighb_weight",
+                                                   "greedy_score_weight", "scores"])
+
+
+def _nbytes(graph):
+    return graph.data.nbytes + graph.indices.nbytes + graph.indptr.nbytes
+
+
+class GraphCache(object):
+    '''neighbor graphs of a set of parcels for any jump up to max_jump, derived from one near table'''
+
+    def __init__(self, parcels, max_jump, budget=512 * 2 ** 20, processes=1):
+        geoms = as_geometries(parcels)
+        self.max_jump = float(max_jump)
+        self.budget = budget
+        self.size = len(geoms)
+        in_fid, near_fid, dist = near_table(geoms, geoms, max_jump, exclude_self=True, processes=processes)
+
+        # the pairs for the largest jump, in CSR order with their distances
+        order = np.lexsort((near_fid, in_fid))
+        self._indptr = np.r_[0, np.cumsum(np.bincount(in_fid, minlength=self.size))]
+        self._indices = near_fid[order]
+        self._distance = dist[order]
+        self._graphs = collections.OrderedDict()
+
+    def nbytes(self):
+        '''memory held by the cached graphs'''
+
+        return sum(_nbytes(graph) for graph in self._graphs.values())
+
+    def graph(self, jump):
+        '''CSR neighbor graph of the parcels within jump'''
+
+        jump = float(jump)
+        if jump > self.max_jump:
+            raise ValueError("jump {0:g} exceeds the {1:g} the cache was built for".format(jump, self.max_jump))
+        if jump in self._graphs:
+            self._graphs.move_to_end(jump)
+            return self._graphs[jump]
+
+        keep = self._distance <= jump
+        rows = np.repeat(np.arange(self.size), np.diff(self._indptr))
+        indptr = np.r_[0, np.cumsum(np.bincount(rows[keep], minlength=self.size))]
+        indices = self._indices[keep]
+        graph = sp.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(self.size, self.size))
+
+        # least recently used graphs go first, but the one just built always stays
+        self._graphs[jump] = graph
+        while len(self._graphs) > 1 and self.nbytes() > self.budget:
+            self._graphs.popitem(last=False)
+        return graph
+
+
+def sweep(parcels, status, jumps, access_weights=(1,), average_neighb_weights=(2,), greedy_score_weights=(4,),
+          method="Greedy", deprioritize=False, averaging_iterations=3, acre_factor=SQFT_PER_ACRE, cache=None,
+          solver=None, processes=1):
+    '''
+    scores the parcels for every combination of jump distance and weights, yielding a SweepPoint per
+    combination. Greedy scores do not depend on the weights and are yielded once per jump with the weights
+    set to None. A GraphCache built for at least max(jumps) may be passed in to reuse it between sweeps, and
+    a PatientSolver to evaluate the averaging passes (not one that stops early: the weights are combined
+    linearly from one run per weight); processes splits the neighbor search of a new cache.
+    '''
+
+    if method not in METHODS:
+        raise ValueError("method must be one of {0}, not {1!r}".format(METHODS, method))
+    if solver is not None and (solver.tol is not None or solver.rank_patience):
+        # each basis run would stop after a different number of passes, so they cannot be combined
+        raise ValueError("sweep() combines the local values of single weights linearly; use a solver without "
+                         "tol or rank_patience")
+    geoms = as_geometries(parcels)
+    area = acreage(geoms, acre_factor)
+    if cache is None:
+        cache = GraphCache(geoms, max(jumps), processes=processes)
+
+    for jump in jumps:
+        scorer = Scorer.from_graph(area, cache.graph(jump), status, method, deprioritize, 1, 0, 0,
+                                   averaging_iterations, solver)
+        if method == "Greedy":
+            yield SweepPoint(jump, None, None, None, scorer.scores)
+            continue
+
+        # local values for each weight on its own
+        basis = [scorer.local] + [scorer.reweight(*unit).local for unit in ((0, 1, 0), (0, 0, 1))]
+        unpreserved = scorer.unpreserved
+        for weights in itertools.product(access_weights, average_neighb_weights, greedy_score_weights):
+            local = sum(w * b for w, b in zip(weights, basis))
+            scores = np.zeros(len(area), dtype=np.int32)
+            scores[unpreserved] = to_score(local[unpreserved])
+            yield SweepPoint(jump, weights[0], weights[1], weights[2], scores)
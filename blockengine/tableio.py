@@ -0,0 +1,109 @@
+"""
+Bulk table I/O between ArcGIS tables and NumPy arrays.
+
+Each stage of BlockGrower reads the fields it needs in a single pass and writes its results back in a
+single pass, instead of walking the table with a legacy UpdateCursor next to a parallel SearchCursor.
+This is the only part of blockengine that needs arcpy, so it is not imported by the package itself.
+"""
+
+import arcpy
+import numpy as np
+
+# WKB of an empty polygon, read for a null shape: it has no area and leaves the parcel out of the analysis
+EMPTY_WKB = b"\x01\x03\x00\x00\x00\x00\x00\x00\x00"
+
+
+def field_type(values):
+    '''AddField type matching a NumPy array'''
+
+    return "INTEGER" if np.issubdtype(np.asarray(values).dtype, np.integer) else "FLOAT"
+
+
+def read_parcels(features, status_field):
+    '''
+    object ids, WKB geometries and preservation status of every feature, read in one pass. The status is a
+    masked array: a missing status reads as -1, so that the parcel is neither preserved nor unpreserved, and
+    is masked. A null shape reads as an empty polygon.
+    '''
+
+    oids = []
+    shapes = []
+    status = []
+    missing = []
+    with arcpy.da.SearchCursor(features, ["OID@", "SHAPE@WKB", status_field]) as rows:
+        for oid, shape, value in rows:
+            oids.append(oid)
+            shapes.append(EMPTY_WKB if shape is None else bytes(shape))
+            status.append(-1 if value is None else value)
+            missing.append(value is None)
+    return (np.array(oids, dtype=np.int64), shapes,
+            np.ma.masked_array(np.array(status, dtype=np.int64), mask=np.array(missing, dtype=bool)))
+
+
+def read_fields(table, fields, null_value=0):
+    '''dict of NumPy arrays holding the object ids ("OID@") and the given fields, read in one pass'''
+
+    array = arcpy.da.TableToNumPyArray(table, ["OID@"] + list(fields), null_value=null_value)
+    return dict((name, array[name]) for name in array.dtype.names)
+
+
+def write_fields(table, values, oids=None):
+    '''
+    writes each array of the values dict to the field of that name in a single UpdateCursor pass, adding
+    fields that do not exist yet. The arrays are aligned with oids, or with the row order of the table when
+    oids is None; rows whose object id is not in oids are left untouched.
+    '''
+
+    existing = set(field.name for field in arcpy.ListFields(table))
+    for name, array in values.items():
+        if name not in existing:
+            arcpy.AddField_management(table, name, field_type(array))
+
+    names = list(values)
+    columns = [np.asarray(values[name]).tolist() for name in names]
+    position = None if oids is None else dict(zip(np.asarray(oids).tolist(), range(len(oids))))
+    with arcpy.da.UpdateCursor(table, ["OID@"] + names) as cur:
+        for i, row in enumerate(cur):
+            j = i if position is None else position.get(row[0])
+            if j is not None:
+                cur.updateRow([row[0]] + [column[j] for column in columns])
+
+
+def _records(oids, values, key):
+    '''structured array of the object ids under key and the arrays of the values dict, for arcpy.da'''
+
+    names = list(values)
+    dtype = [(key, np.int32)] + [(name, np.int32 if field_type(values[name]) == "INTEGER" else np.float64)
+                                 for name in names]
+    array = np.zeros(len(oids), dtype=dtype)
+    array[key] = oids
+    for name in names:
+        array[name] = values[name]
+    return array
+
+
+def add_fields(table, values, oids=None):
+    '''
+    writes the arrays of the values dict like write_fields, but adds all fields that do not exist yet
+    together with their values in one arcpy.da.ExtendTable pass, rather than an AddField per field (each of
+    which rewrites a shapefile's DBF) followed by a cursor pass. Existing fields are updated in place.
+    '''
+
+    existing = set(field.name for field in arcpy.ListFields(table))
+    new = dict((name, array) for name, array in values.items() if name not in existing)
+    old = dict((name, array) for name, array in values.items() if name in existing)
+    if oids is None:
+        oids = read_fields(table, [])["OID@"]
+    if new:
+        arcpy.da.ExtendTable(table, arcpy.Describe(table).OIDFieldName, _records(oids, new, "ROW_OID"), "ROW_OID",
+                             append_only=False)
+    if old:
+        write_fields(table, old, oids)
+
+
+def write_table(table, oids, values, key="FID"):
+    '''writes a new table holding the object ids under key and the arrays of the values dict, for joining'''
+
+    if arcpy.Exists(table):
+        arcpy.Delete_management(table)
+    arcpy.da.NumPyArrayToTable(_records(oids, values, key), table)
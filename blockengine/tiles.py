@@ -0,0 +1,261 @@
+"""
+Tiled, streaming scoring of parcel layers too large to hold in memory.
+
+The parcel file is read three times and never held in memory as a whole:
+
+1   a scan keeps only the FID, bounding box, acreage and status of each parcel;
+2   the parcels are assigned to square tiles by the centre of their bounding box and streamed once into
+    per-tile bucket files on disk, each tile with a halo reaching jump beyond its parcels' bounding boxes,
+    so every neighbor within jump of a tile's parcels is present and the tile's near pairs are exact;
+3   after scoring, the parcels are streamed once more and written out with their scores in chunks.
+
+The near pairs of all tiles are stitched into one neighbor graph, so blob areas, access sums and Patient
+averaging are exactly those of an untiled run. Geometry in memory is bounded by the tile size; what grows
+with the input is a few numbers per parcel and per near pair.
+
+Reading and GeoPackage output need fiona; Parquet output needs pyarrow.
+"""
+
+import collections
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import shapely
+import shapely.geometry
+
+from .graph import adjacency, near_pairs
+from .scoring import SCORE_FIELDS, SQFT_PER_ACRE, Scorer
+
+ParcelIndex = collections.namedtuple("ParcelIndex", ["fids", "bounds", "area", "status"])
+
+# features written per chunk in the output pass
+CHUNK = 10000
+
+
+def _open(path, layer=None, mode="r", **kwargs):
+    try:
+        import fiona
+    except ImportError:
+        raise ImportError("tiled processing reads and writes parcel files with fiona; pip install fiona")
+    return fiona.open(path, mode, layer=layer, **kwargs)
+
+
+def _shape(geometry):
+    '''shapely geometry of a feature; a null geometry, legal in shapefiles, reads as an empty polygon'''
+
+    return shapely.geometry.Polygon() if geometry is None else shapely.geometry.shape(geometry)
+
+
+def scan(path, status_field, layer=None, acre_factor=SQFT_PER_ACRE):
+    '''
+    first pass: FID, bounding box, acreage and status (-1 when missing) of every parcel, in file order. A
+    parcel with a null or empty geometry has NaN bounds and no area.
+    '''
+
+    fids = []
+    bounds = []
+    area = []
+    status = []
+    with _open(path, layer) as source:
+        for feature in source:
+            geom = _shape(feature["geometry"])
+            value = feature["properties"][status_field]
+            fids.append(int(feature["id"]))
+            bounds.append(geom.bounds)
+            area.append(geom.area / float(acre_factor))
+            status.append(-1 if value is None else value)
+    return ParcelIndex(np.array(fids, dtype=np.int64), np.array(bounds, dtype=float).reshape(-1, 4),
+                       np.array(area), np.array(status, dtype=np.int64))
+
+
+def assign_tiles(bounds, tile_size):
+    '''tile number of every parcel, from the centre of its bounding box on a grid of tile_size squares'''
+
+    if len(bounds) == 0:
+        return np.zeros(0, dtype=np.intp)
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2
+    col = np.floor((cx - cx.min()) / tile_size).astype(np.int64)
+    row = np.floor((cy - cy.min()) / tile_size).astype(np.int64)
+    _, tile = np.unique(row * (col.max() + 1) + col, return_inverse=True)
+    return tile.ravel()
+
+
+def _halo_windows(bounds, groups, jump):
+    '''bounding box of each tile's parcels, widened by jump on every side'''
+
+    windows = np.empty((len(groups), 4))
+    for t, owned in enumerate(groups):
+        box = bounds[owned]
+        windows[t] = (box[:, 0].min() - jump, box[:, 1].min() - jump, box[:, 2].max() + jump, box[:, 3].max() + jump)
+    return windows
+
+
+def _bucket(path, index, windows, folder, layer=None):
+    '''
+    second pass: streams the parcels once, appending each one (scan position and WKB) to the bucket file of
+    every tile whose halo window its bounding box intersects
+    '''
+
+    tree = shapely.STRtree(shapely.box(windows[:, 0], windows[:, 1], windows[:, 2], windows[:, 3]))
+
+    def flush(start, geoms):
+        # parcels without geometry (NaN bounds) belong to no tile
+        bounds = index.bounds[start:start + len(geoms)]
+        located = np.flatnonzero(np.isfinite(bounds).all(axis=1))
+        bounds = bounds[located]
+        rows, tile = tree.query(shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]),
+                                predicate="intersects")
+        rows = located[rows]
+        wkb = shapely.to_wkb(np.array(geoms, dtype=object))
+        order = np.argsort(tile, kind="stable")
+        rows, tile = rows[order], tile[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(tile)) + 1] if len(tile) else []
+        for first, members in zip(starts, np.split(rows, starts[1:])):
+            with open(os.path.join(folder, "{0}.pkl".format(tile[first])), "ab") as f:
+                pickle.dump((start + members, wkb[members]), f, pickle.HIGHEST_PROTOCOL)
+
+    geoms = []
+    start = 0
+    with _open(path, layer) as source:
+        for feature in source:
+            geoms.append(_shape(feature["geometry"]))
+            if len(geoms) == CHUNK:
+                flush(start, geoms)
+                start += len(geoms)
+                geoms = []
+    if geoms:
+        flush(start, geoms)
+
+
+def _read_bucket(folder, t):
+    '''scan positions and geometries of the parcels bucketed for tile t'''
+
+    positions = []
+    wkb = []
+    with open(os.path.join(folder, "{0}.pkl".format(t)), "rb") as f:
+        while True:
+            try:
+                members, chunk = pickle.load(f)
+            except EOFError:
+                break
+            positions.append(members)
+            wkb.append(chunk)
+    return np.concatenate(positions), shapely.from_wkb(np.concatenate(wkb))
+
+
+def tiled_graph(path, index, jump, tile_size, layer=None):
+    '''
+    the jump distance neighbor graph of all parcels, built one tile (plus halo) at a time. The parcels are
+    bucketed into the tiles in a single pass over the file, so the cost does not grow with the number of
+    tiles; the buckets live in a temporary folder and hold every parcel once plus the halo copies. Parcels
+    without geometry are in no tile and have no neighbors.
+    '''
+
+    n = len(index.fids)
+    located = np.flatnonzero(np.isfinite(index.bounds).all(axis=1))
+    if len(located) == 0:
+        return adjacency(np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), (n, n))
+    tile = np.full(n, -1, dtype=np.intp)
+    tile[located] = assign_tiles(index.bounds[located], tile_size)
+    order = located[np.argsort(tile[located], kind="stable")]
+    groups = np.split(order, np.flatnonzero(np.diff(tile[order])) + 1)
+    windows = _halo_windows(index.bounds, groups, jump)
+
+    in_parts = []
+    near_parts = []
+    with tempfile.TemporaryDirectory(prefix="blockengine-tiles-") as folder:
+        _bucket(path, index, windows, folder, layer)
+        for t in range(len(groups)):
+            positions, geoms = _read_bucket(folder, t)
+
+            # pairs from the tile's own parcels only, so each pair is found exactly once
+            local = np.flatnonzero(tile[positions] == t)
+            in_fid, near_fid = near_pairs(geoms[local], geoms, jump)
+            in_fid, near_fid = positions[local][in_fid], positions[near_fid]
+            keep = in_fid != near_fid
+            in_parts.append(in_fid[keep])
+            near_parts.append(near_fid[keep])
+
+    return adjacency(np.concatenate(in_parts), np.concatenate(near_parts), (n, n))
+
+
+def write_scores(path, output, fields, fids, layer=None, output_layer=None):
+    '''
+    third pass: streams the parcels to output with the given per-parcel arrays (aligned with the scan) as
+    extra attributes. A .parquet output is a score table holding only the FIDs and the arrays; any other
+    output is written with fiona, GeoPackage for .gpkg. Masked entries of masked arrays are written as nulls.
+    '''
+
+    names = list(fields)
+    columns = [np.ma.getdata(fields[name]) for name in names]
+    masks = [np.ma.getmaskarray(fields[name]) for name in names]
+    if os.path.splitext(output)[1].lower() == ".parquet":
+        _write_parquet(output, fids, names, columns, masks)
+        return
+
+    with _open(path, layer) as source:
+        schema = dict(source.schema)
+        properties = dict(schema["properties"])
+        for name, column in zip(names, columns):
+            properties[name] = "int" if np.issubdtype(column.dtype, np.integer) else "float"
+        schema["properties"] = properties
+        driver = "GPKG" if output.lower().endswith(".gpkg") else source.driver
+        with _open(output, output_layer, "w", driver=driver, crs=source.crs, schema=schema) as sink:
+            chunk = []
+            for i, feature in enumerate(source):
+                record = {"geometry": feature["geometry"], "properties": dict(feature["properties"])}
+                for name, column, mask in zip(names, columns, masks):
+                    record["properties"][name] = None if mask[i] else column[i].item()
+                chunk.append(record)
+                if len(chunk) == CHUNK:
+                    sink.writerecords(chunk)
+                    chunk = []
+            sink.writerecords(chunk)
+
+
+def _write_parquet(output, fids, names, columns, masks):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet output needs pyarrow; pip install pyarrow")
+
+    schema = pyarrow.schema([("FID", pyarrow.int64())] +
+                            [(name, pyarrow.from_numpy_dtype(column.dtype)) for name, column in zip(names, columns)])
+    with pyarrow.parquet.ParquetWriter(output, schema) as writer:
+        for start in range(0, len(fids), CHUNK):
+            stop = start + CHUNK
+            arrays = [pyarrow.array(column[start:stop], mask=mask[start:stop] if mask.any() else None)
+                      for column, mask in zip(columns, masks)]
+            writer.write_table(pyarrow.table([fids[start:stop]] + arrays, schema=schema))
+
+
+def tiled_scorer(path, status_field, tile_size, method="Greedy", jump=0, deprioritize=False, access_weight=1,
+                 average_neighb_weight=2, greedy_score_weight=4, averaging_iterations=3, acre_factor=SQFT_PER_ACRE,
+                 layer=None, solver=None):
+    '''
+    the ParcelIndex of a parcel file and a Scorer of its parcels, whose neighbor graph is built tile by tile.
+    Only geometry is bounded by the tile size; the graph and the Scorer's arrays cover every parcel.
+    '''
+
+    index = scan(path, status_field, layer, acre_factor)
+    graph = tiled_graph(path, index, jump, tile_size, layer)
+    return index, Scorer.from_graph(index.area, graph, index.status, method, deprioritize, access_weight,
+                                    average_neighb_weight, greedy_score_weight, averaging_iterations, solver)
+
+
+def score_tiled(path, status_field, output, tile_size, method="Greedy", jump=0, deprioritize=False,
+                access_weight=1, average_neighb_weight=2, greedy_score_weight=4, averaging_iterations=3,
+                acre_factor=SQFT_PER_ACRE, layer=None, output_layer=None):
+    '''
+    scores a parcel file tile by tile and writes the parcels with their score to output (GeoPackage,
+    Parquet or any other fiona format). Returns the Scorer, which holds no geometry.
+    '''
+
+    index, scorer = tiled_scorer(path, status_field, tile_size, method, jump, deprioritize, access_weight,
+                                 average_neighb_weight, greedy_score_weight, averaging_iterations, acre_factor, layer)
+    write_scores(path, output, {SCORE_FIELDS[method]: scorer.scores}, index.fids, layer, output_layer)
+    return scorer
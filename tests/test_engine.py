@@ -0,0 +1,480 @@
+"""
+Tests of the scoring engine: incremental re-scoring, preserve selection, Monte Carlo simulation, parallel and
+tiled neighbor graphs, the Patient solvers, the parcel store, parameter sweeps, batch jobs and profiling.
+
+    pytest -q
+"""
+
+import json
+import multiprocessing
+import os
+import tracemalloc
+
+import numpy as np
+import pytest
+import shapely
+import shapely.geometry
+
+from blockengine import graph as graph_module
+from blockengine import profiling, scoring
+from blockengine import (GraphCache, PatientSolver, Scorer, neighbor_graph, open_store, random_parcels, simulate,
+                         sweep, top_parcels)
+from blockengine.montecarlo import monte_carlo
+from blockengine.scoring import SCORE_FIELDS, SQFT_PER_ACRE
+
+
+def fabric(side=12, seed=0):
+    '''a side x side grid of rectangular parcels of random size, 100 feet apart'''
+
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(side) * 100.0, np.arange(side) * 100.0)
+    x, y = x.ravel(), y.ravel()
+    width, height = rng.uniform(60, 100, (2, len(x)))
+    return shapely.box(x, y, x + width, y + height)
+
+
+def status_of(count, seed=0):
+    '''mostly unpreserved parcels, some preserved (1) and some left out of the analysis (-1)'''
+
+    return np.random.default_rng(seed).choice([0, 1, -1], count, p=[0.8, 0.15, 0.05])
+
+
+def write_parcels(path, geoms, status):
+    '''writes the parcels to a shapefile with their status, null for -1 (and a null geometry for None)'''
+
+    import fiona
+
+    schema = {"geometry": "Polygon", "properties": {"Status": "int"}}
+    with fiona.open(path, "w", driver="ESRI Shapefile", schema=schema) as sink:
+        for geom, value in zip(geoms, status):
+            sink.write({"geometry": None if geom is None else shapely.geometry.mapping(geom),
+                        "properties": {"Status": None if value == -1 else int(value)}})
+    return path
+
+
+@pytest.mark.parametrize("method", ["Greedy", "Patient"])
+@pytest.mark.parametrize("jump", [0, 30])
+def test_incremental_scores_match_full_rescoring(method, jump):
+    geoms = fabric()
+    status = status_of(len(geoms))
+    scorer = Scorer(geoms, status, method, jump, True)
+    simulate(scorer, 4, 5)
+
+    full = Scorer(geoms, np.where(scorer.preserved, 1, status), method, jump, True)
+    assert np.array_equal(scorer.preserved, full.preserved)
+    np.testing.assert_allclose(scorer.weights, full.weights, rtol=1e-9, atol=1e-12)
+    assert np.array_equal(scorer.scores, full.scores)
+
+
+def test_many_averaging_passes_use_a_solver_instead_of_the_pass_history():
+    geoms = fabric()
+    status = status_of(len(geoms))
+    few = Scorer(geoms, status, "Patient", 30, averaging_iterations=scoring.HISTORY_PASSES)
+    many = Scorer(geoms, status, "Patient", 30, averaging_iterations=scoring.HISTORY_PASSES + 80)
+    assert few.solver is None and few.history.shape == (scoring.HISTORY_PASSES + 1, len(geoms))
+    assert many.solver.method == "iterate" and many.history.shape == (2, len(geoms))
+
+
+@pytest.mark.parametrize("method", ["iterate", "krylov"])
+@pytest.mark.parametrize("iterations", [3, 25])
+def test_patient_solver_matches_averaging_passes(monkeypatch, method, iterations):
+    # keep the full pass history, which Scorer would otherwise trade for a solver above HISTORY_PASSES
+    monkeypatch.setattr(scoring, "HISTORY_PASSES", iterations)
+    geoms = fabric()
+    status = status_of(len(geoms))
+    passes = Scorer(geoms, status, "Patient", 30, True, averaging_iterations=iterations)
+    solved = Scorer(geoms, status, "Patient", 30, True, averaging_iterations=iterations,
+                    solver=PatientSolver(method))
+    for _ in range(2):
+        expected, actual = passes.fields(), solved.fields()
+        for name in ("PatientWgt", "LocalValue"):
+            np.testing.assert_allclose(actual[name], expected[name], rtol=1e-9, atol=1e-9)
+        assert np.array_equal(actual["PatientScr"], expected["PatientScr"])
+        simulate(passes, 2, 5)
+        simulate(solved, 2, 5)
+        assert np.array_equal(passes.preserved, solved.preserved)
+
+
+@pytest.mark.parametrize("options", [{"tol": 1e-6}, {"rank_patience": 3}])
+def test_patient_solver_stops_early(options):
+    graph = neighbor_graph(fabric(), 30)
+    patient = np.random.default_rng(0).uniform(0, 100, graph.shape[0])
+    exact = PatientSolver("iterate").solve(patient, graph, 2000)
+    early = PatientSolver("iterate", **options).solve(patient, graph, 2000)
+    assert early.converged and early.iterations < 2000
+    # the passes left are added at the weights of the last pass taken
+    taken = PatientSolver("iterate").solve(patient, graph, early.iterations)
+    np.testing.assert_allclose(early.local, taken.local + (2000 - early.iterations) * taken.patient, rtol=1e-12)
+    if "tol" in options:
+        np.testing.assert_allclose(early.local, exact.local, rtol=1e-3)
+
+
+def test_top_parcels_breaks_ties_by_weight_tiebreak_and_index():
+    scores = np.array([5, 5, 5, 1])
+    candidates = np.ones(4, dtype=bool)
+    assert list(top_parcels(scores, candidates, 2)) == [0, 1]
+    assert list(top_parcels(scores, candidates, 2, weights=np.array([1.0, 2.0, 1.0, 9.0]))) == [1, 0]
+    assert list(top_parcels(scores, candidates, 2, tiebreak=np.array([1.0, 3.0, 2.0, 9.0]))) == [1, 2]
+    assert list(top_parcels(scores, candidates, 2, tiebreak=np.array(["b", "a", "c", "z"]))) == [2, 0]
+
+
+def test_top_parcels_takes_every_candidate_when_fewer_remain():
+    scores = np.array([1, 7, 3, 9])
+    candidates = np.array([True, False, True, False])
+    assert list(top_parcels(scores, candidates, 10)) == [2, 0]
+    assert len(top_parcels(scores, np.zeros(4, dtype=bool), 3)) == 0
+
+
+def test_random_parcels_skips_unwilling_owners():
+    scores = np.arange(1, 41)
+    candidates = np.ones(40, dtype=bool)
+    willingness = np.tile([0.0, 1.0, 0.5, 1.0], 10)
+    rng = np.random.default_rng(0)
+    drawn = np.concatenate([random_parcels(scores, candidates, 5, rng, weighted, willingness)
+                            for weighted in (True, False) for _ in range(200)])
+    assert len(drawn) == 2000
+    assert not np.any(willingness[drawn] == 0)
+    assert np.any(willingness[drawn] == 0.5)
+    assert len(random_parcels(scores, candidates, 5, rng, True, np.zeros(40))) == 0
+    # owners who all refuse but one: only that parcel can be drawn
+    assert list(random_parcels(scores, candidates, 5, rng, True, np.eye(40)[7])) == [7]
+
+
+@pytest.mark.parametrize("willing", [False, True])
+def test_monte_carlo_does_not_depend_on_the_number_of_processes(willing):
+    geoms = fabric()
+    scorer = Scorer(geoms, status_of(len(geoms)), "Greedy", 30, True)
+    willingness = np.random.default_rng(1).uniform(0, 1, len(geoms)) if willing else None
+    results = [monte_carlo(scorer, 12, 3, 4, seed=7, willingness=willingness, processes=processes)
+               for processes in (1, 2, 3)]
+    for result in results[1:]:
+        assert np.array_equal(result.frequency, results[0].frequency)
+        assert np.array_equal(result.largest_blob, results[0].largest_blob)
+        assert all(np.array_equal(a, b) for a, b in zip(result.blob_areas, results[0].blob_areas))
+    assert np.all(results[0].frequency[scorer.preserved] == 1)
+
+
+@pytest.mark.parametrize("jump", [0, 30])
+def test_parallel_neighbor_graph_matches_serial(monkeypatch, jump):
+    geoms = fabric(20)
+    serial = neighbor_graph(geoms, jump)
+    # small chunks, so the 400 parcels are split across the worker processes
+    monkeypatch.setattr(graph_module, "MIN_CHUNK", 50)
+    parallel = neighbor_graph(geoms, jump, processes=2)
+    assert serial.shape == parallel.shape
+    assert (serial != parallel).nnz == 0
+
+
+@pytest.mark.parametrize("method", ["Greedy", "Patient"])
+def test_tiled_scores_match_untiled(tmp_path, method):
+    fiona = pytest.importorskip("fiona")
+    from blockengine.tiles import score_tiled
+
+    geoms = fabric()
+    status = status_of(len(geoms))
+    path = write_parcels(str(tmp_path / "parcels.shp"), geoms, status)
+
+    expected = Scorer(geoms, status, method, 30, True, acre_factor=SQFT_PER_ACRE)
+    # tiles of 3 x 3 parcels, so most neighbor pairs of the jump cross a tile edge
+    tiled = score_tiled(path, "Status", str(tmp_path / "scores.gpkg"), 300, method, 30, True,
+                        acre_factor=SQFT_PER_ACRE)
+    assert np.array_equal(tiled.scores, expected.scores)
+    with fiona.open(str(tmp_path / "scores.gpkg")) as source:
+        written = [feature["properties"][SCORE_FIELDS[method]] for feature in source]
+    assert written == list(expected.scores)
+
+
+def test_store_reopens_an_unchanged_source_and_rebuilds_a_changed_one(tmp_path):
+    geoms = fabric(6)
+    status = status_of(len(geoms))
+    source = tmp_path / "parcels.gpkg"
+    source.write_bytes(b"parcels")
+    reads = []
+
+    def parcels():
+        reads.append(1)
+        return geoms
+
+    def reopen(layer="parcels"):
+        del reads[:]
+        return open_store(str(tmp_path / "store"), parcels, status, np.arange(len(geoms)), SQFT_PER_ACRE,
+                          str(source), layer)
+
+    reopen().graph(30, parcels)
+    store = reopen()
+    assert reads == [] and store.has_graph(30)
+    expected = Scorer(geoms, status, "Greedy", 30, False, acre_factor=SQFT_PER_ACRE)
+    assert np.array_equal(store.scorer(30).scores, expected.scores)
+    assert not store.matches_source(str(source), SQFT_PER_ACRE, "parcels", len(geoms) - 1)
+
+    # another layer of the same file
+    store = reopen("other")
+    assert reads == [1] and not store.has_graph(30)
+    reopen("other")
+    assert reads == []
+
+    # the file touched, then rewritten
+    stat = os.stat(str(source))
+    os.utime(str(source), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    reopen("other")
+    assert reads == [1]
+    source.write_bytes(b"other parcels")
+    reopen("other")
+    assert reads == [1]
+
+
+def test_jobs_sharing_a_store_run_concurrently(tmp_path):
+    fiona = pytest.importorskip("fiona")
+    from blockengine.batch import Job, run_jobs
+
+    geoms = fabric()
+    path = write_parcels(str(tmp_path / "parcels.shp"), geoms, status_of(len(geoms)))
+    store = str(tmp_path / "store")
+    jobs = [Job(path, "Status", str(tmp_path / "scored{0}.gpkg".format(i)), "Patient", jump,
+                access_weight=weight, acre_factor=SQFT_PER_ACRE, store=store)
+            for i, (jump, weight) in enumerate((jump, weight) for jump in (30, 40) for weight in (1, 2, 3))]
+    for _ in range(2):
+        results = run_jobs(jobs, workers=6)
+        assert [result.error for result in results] == [None] * len(jobs)
+    assert open_store(store, None, None, np.arange(len(geoms)), SQFT_PER_ACRE, path).meta["jumps"] == [30, 40]
+    assert not [name for name in os.listdir(store) if name.endswith(".tmp")]
+
+    for job in jobs:
+        expected = Scorer(geoms, status_of(len(geoms)), "Patient", job.jump, False, job.access_weight,
+                          acre_factor=SQFT_PER_ACRE)
+        with fiona.open(job.output) as source:
+            assert [feature["properties"]["PatientScr"] for feature in source] == list(expected.scores)
+
+
+@pytest.mark.parametrize("method", ["Greedy", "Patient"])
+def test_sweep_matches_direct_scoring(method):
+    geoms = fabric()
+    status = status_of(len(geoms))
+    points = list(sweep(geoms, status, [0, 30, 60], (1, 3), (0, 2), (4, 0.5), method, True))
+    assert len(points) == (3 if method == "Greedy" else 24)
+    for point in points:
+        weights = (1, 2, 4) if method == "Greedy" else point[1:4]
+        expected = Scorer(geoms, status, method, point.jump, True, *weights, acre_factor=SQFT_PER_ACRE)
+        assert np.array_equal(point.scores, expected.scores)
+
+
+def test_graph_cache_evicts_least_recently_used_graphs():
+    geoms = fabric()
+    cache = GraphCache(geoms, 60)
+    for jump in (0, 30, 60):
+        assert (cache.graph(jump) != neighbor_graph(geoms, jump)).nnz == 0
+
+    # no room for all three graphs and another: the one used least recently goes
+    near, middle, far = cache.graph(0), cache.graph(30), cache.graph(60)
+    cache.budget = cache.nbytes() - 1
+    near = cache.graph(0)
+    cache.graph(15)
+    assert cache.graph(0) is near and cache.graph(30) is not middle
+
+    # without room for any, only the newest graph stays
+    cache.budget = 0
+    far = cache.graph(60)
+    assert cache.nbytes() == far.data.nbytes + far.indices.nbytes + far.indptr.nbytes
+    assert cache.graph(60) is far and cache.graph(0) is not near
+
+
+def test_manifest_entries_are_converted_and_filled_with_defaults(tmp_path):
+    pytest.importorskip("fiona")
+    from blockengine.batch import Job, make_job, read_manifest
+
+    (tmp_path / "jobs.csv").write_text("parcels,status_field,output,method,jump,simulate,layer,processes\n"
+                                       "a.shp,Status,a.gpkg,Patient,100,yes,,0\n"
+                                       "b.shp,Status,b.gpkg,,,,parcels,2\n")
+    (tmp_path / "jobs.json").write_text(json.dumps([
+        {"parcels": "a.shp", "status_field": "Status", "output": "a.gpkg", "method": "Patient", "jump": "100",
+         "simulate": True, "layer": None, "processes": 0},
+        {"parcels": "b.shp", "status_field": "Status", "output": "b.gpkg", "layer": "parcels", "processes": 2}]))
+
+    for name in ("jobs.csv", "jobs.json"):
+        first, second = read_manifest(str(tmp_path / name))
+        assert first == Job("a.shp", "Status", "a.gpkg", "Patient", 100.0, simulate=True, processes=None)
+        assert second == Job("b.shp", "Status", "b.gpkg", layer="parcels", processes=2)
+        assert second.method == "Greedy" and second.jump == 0 and second.averaging_iterations == 3
+    with pytest.raises(ValueError):
+        make_job({"parcels": "a.shp", "status_field": "Status", "output": "a.gpkg", "jumps": "100"})
+    with pytest.raises(ValueError):
+        make_job({"parcels": "a.shp", "status_field": "Status", "output": "a.gpkg", "method": "Eager"})
+
+
+def test_job_keeps_null_statuses_and_preserves_only_unpreserved_parcels(tmp_path):
+    fiona = pytest.importorskip("fiona")
+    from blockengine.batch import Job, run_job
+
+    geoms = fabric()
+    status = status_of(len(geoms))
+    path = write_parcels(str(tmp_path / "parcels.shp"), geoms, status)
+    job = Job(path, "Status", str(tmp_path / "scored.gpkg"), "Patient", 30, simulate=True, simulations=3,
+              num_preserve=5, acre_factor=SQFT_PER_ACRE)
+    result = run_job(job)
+    assert result.error is None and result.parcels == len(geoms) and result.preserved == 15
+
+    with fiona.open(job.output) as source:
+        written = [feature["properties"]["Status"] for feature in source]
+    for before, after in zip(status, written):
+        assert after is None if before == -1 else after in (before, 1)
+    assert sum(after == 1 for after in written) == np.count_nonzero(status == 1) + 15
+
+
+@pytest.mark.parametrize("method", ["Greedy", "Patient"])
+def test_tiled_job_matches_untiled_job(tmp_path, method):
+    fiona = pytest.importorskip("fiona")
+    from blockengine.batch import Job, run_job
+    from blockengine.cli import main
+
+    geoms = fabric()
+    path = write_parcels(str(tmp_path / "parcels.shp"), geoms, status_of(len(geoms)))
+    job = Job(path, "Status", str(tmp_path / "untiled.gpkg"), method, 30, simulate=True, simulations=3,
+              acre_factor=SQFT_PER_ACRE)
+    run_job(job)
+    assert main([path, "Status", str(tmp_path / "tiled.gpkg"), "--method", method, "--jump", "30", "--simulate",
+                 "--simulations", "3", "--acre-factor", str(SQFT_PER_ACRE), "--tile-size", "300"]) == 0
+
+    fields = ["Status", SCORE_FIELDS[method]]
+    outputs = []
+    for name in ("untiled.gpkg", "tiled.gpkg"):
+        with fiona.open(str(tmp_path / name)) as source:
+            outputs.append([[feature["properties"][field] for field in fields] for feature in source])
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize("tile_size", [None, 300])
+def test_job_leaves_parcels_without_geometry_out(tmp_path, tile_size):
+    fiona = pytest.importorskip("fiona")
+    from blockengine.batch import Job, run_job
+
+    geoms = fabric()
+    status = np.zeros(len(geoms), dtype=int)
+    status[:3] = 1
+    missing = [3, 40, 77]
+    path = write_parcels(str(tmp_path / "parcels.shp"), np.where(np.isin(np.arange(len(geoms)), missing), None,
+                                                                 geoms), status)
+    job = Job(path, "Status", str(tmp_path / "scored.gpkg"), "Patient", 30, simulate=True, simulations=2,
+              acre_factor=SQFT_PER_ACRE, tile_size=tile_size)
+    assert run_job(job).error is None
+
+    geoms[missing] = shapely.Polygon()
+    expected = Scorer(geoms, np.where(np.isin(np.arange(len(geoms)), missing), -1, status), "Patient", 30, False,
+                      acre_factor=SQFT_PER_ACRE)
+    simulate(expected, 1, 5)
+    with fiona.open(job.output) as source:
+        written = [feature["properties"] for feature in source]
+    assert [properties["PatientScr"] for properties in written] == list(expected.scores)
+    assert all(written[i]["Status"] == 0 and written[i]["PatientScr"] == 0 for i in missing)
+
+
+def test_monte_carlo_of_a_job_runs_on_its_own_processes(tmp_path, monkeypatch):
+    pytest.importorskip("fiona")
+    from blockengine import batch
+    from blockengine.cli import parser
+
+    geoms = fabric(4)
+    path = write_parcels(str(tmp_path / "parcels.shp"), geoms, status_of(len(geoms)))
+    options = vars(parser().parse_args([path, "Status", str(tmp_path / "scored.gpkg"), "--trajectories", "8",
+                                        "--acre-factor", str(SQFT_PER_ACRE)]))
+    del options["manifest"], options["workers"]
+    job = batch.make_job(options)
+    assert job.processes == 1 and job.mc_processes is None
+    assert batch.make_job(dict(options, mc_processes="2")).mc_processes == 2
+
+    calls = []
+    serial = batch.monte_carlo
+
+    def monte_carlo(*args, **kwargs):
+        calls.append(kwargs["processes"])
+        return serial(*args, **dict(kwargs, processes=1))
+
+    monkeypatch.setattr(batch, "monte_carlo", monte_carlo)
+    assert batch.run_job(job).error is None
+    assert calls == [None]
+
+
+def test_failing_job_is_reported_without_stopping_the_others(tmp_path, capsys):
+    pytest.importorskip("fiona")
+    from blockengine.batch import Job, run_jobs
+    from blockengine.cli import main
+
+    geoms = fabric(4)
+    path = write_parcels(str(tmp_path / "parcels.shp"), geoms, status_of(len(geoms)))
+    jobs = [Job(str(tmp_path / "missing.shp"), "Status", str(tmp_path / "missing.gpkg"), acre_factor=SQFT_PER_ACRE),
+            Job(path, "Status", str(tmp_path / "scored.gpkg"), acre_factor=SQFT_PER_ACRE)]
+    failed, scored = run_jobs(jobs, workers=1)
+    assert failed.error is not None and "missing.shp" in failed.error
+    assert scored.error is None and scored.parcels == len(geoms)
+
+    manifest = tmp_path / "jobs.json"
+    manifest.write_text(json.dumps([job._asdict() for job in jobs]))
+    assert main(["--manifest", str(manifest), "--workers", "1"]) == 1
+    assert "FAILED" in capsys.readouterr().out
+
+
+def test_job_whose_worker_dies_does_not_stop_the_others(monkeypatch):
+    pytest.importorskip("fiona")
+    from blockengine import batch
+
+    if multiprocessing.get_start_method() != "fork":
+        pytest.skip("the replaced run_job only reaches forked workers")
+
+    def run_job(job):
+        if job.parcels == "crash":
+            os._exit(1)
+        return batch.JobResult(job, 1, 0, 0.0, None)
+
+    monkeypatch.setattr(batch, "run_job", run_job)
+    jobs = [batch.Job(name, "Status", name + ".gpkg") for name in ("a", "b", "crash", "c", "d", "e", "f")]
+    finished = []
+    results = batch.run_jobs(jobs, workers=3, callback=finished.append)
+    assert [result.job.parcels for result in results] == [job.parcels for job in jobs]
+    assert [result.error is None for result in results] == [True, True, False, True, True, True, True]
+    assert "died" in results[2].error
+    assert len(finished) == len(jobs)
+
+
+def test_stage_records_nothing_without_a_tracer():
+    tracer = profiling.Tracer()
+    with profiling.stage("read parcels", rows=3) as counts:
+        counts["pairs"] = 7
+    assert counts == {"rows": 3, "pairs": 7}
+    assert tracer.records == []
+
+
+def test_tracer_records_failed_and_nested_stages(tmp_path):
+    tracer = profiling.Tracer(memory=True)
+    try:
+        with profiling.installed(tracer):
+            with profiling.stage("outer", rows=10):
+                with profiling.stage("inner") as counts:
+                    counts["pairs"] = 4
+                    block = np.ones(2 ** 20)
+                    del block
+                with pytest.raises(ValueError):
+                    with profiling.stage("failing"):
+                        raise ValueError("stage failed")
+            with profiling.stage("last"):
+                pass
+    finally:
+        tracemalloc.stop()
+
+    records = dict((record["name"], record) for record in tracer.records)
+    assert set(records) == {"outer", "inner", "failing", "last"}
+    assert [records[name]["depth"] for name in ("outer", "inner", "failing", "last")] == [0, 1, 1, 0]
+    # the 8 MB array of the inner stage is carried up to the outer one
+    assert records["inner"]["traced_peak"] >= 8 * 2 ** 20
+    assert records["outer"]["traced_peak"] >= records["inner"]["traced_peak"]
+
+    lines = tracer.summary()
+    assert [line.split(":")[0] for line in lines] == ["outer", "  inner", "  failing", "last"]
+    assert "(pairs 4)" in lines[1]
+
+    path = str(tmp_path / "trace.json")
+    tracer.write_chrome_trace(path)
+    with open(path) as f:
+        events = json.load(f)["traceEvents"]
+    assert len(events) == 4 and all(event["ph"] == "X" and event["dur"] >= 0 for event in events)
+    arguments = dict((event["name"], event["args"]) for event in events)
+    assert arguments["outer"]["rows"] == 10 and arguments["inner"]["pairs"] == 4
+    assert arguments["inner"]["traced_peak"] == records["inner"]["traced_peak"]